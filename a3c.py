@@ -2,13 +2,22 @@ from __future__ import print_function
 from collections import namedtuple
 import numpy as np
 import tensorflow as tf
-from model import LSTMPolicy
+from model import create_policy, FrozenPolicy
+from inference import RemotePolicy
+from trajectory import TrajectoryRecorder
 import six.moves.queue as queue
 import scipy.signal
 import threading
 import distutils.version
 use_tf12_api = distutils.version.LooseVersion(tf.VERSION) >= distutils.version.LooseVersion('0.12.0')
 
+# Disables write_meta_graph argument, which freezes entire process and is mostly useless.
+class FastSaver(tf.train.Saver):
+    def save(self, sess, save_path, global_step=None, latest_filename=None,
+             meta_graph_suffix="meta", write_meta_graph=True):
+        super(FastSaver, self).save(sess, save_path, global_step, latest_filename,
+                                    meta_graph_suffix, False)
+
 def discount(x, gamma):
     return scipy.signal.lfilter([1], [1, -gamma], x[::-1], axis=0)[::-1]
 
@@ -17,7 +26,7 @@ def process_rollout(rollout, gamma, lambda_=1.0):
 given a rollout, compute its returns and the advantage
 """
     batch_si = np.asarray(rollout.states)
-    batch_a = np.asarray(rollout.actions)
+    batch_a = np.asarray(rollout.actions, dtype=np.int32)
     rewards = np.asarray(rollout.rewards)
     vpred_t = np.asarray(rollout.values + [rollout.r])
 
@@ -71,7 +80,7 @@ One of the key distinctions between a normal environment and a universe environm
 is that a universe environment is _real time_.  This means that there should be a thread
 that would constantly interact with the environment and tell it what to do.  This thread is here.
 """
-    def __init__(self, env, policy, num_local_steps):
+    def __init__(self, env, policy, num_local_steps, recorder=None):
         threading.Thread.__init__(self)
         self.queue = queue.Queue(5)
         self.num_local_steps = num_local_steps
@@ -81,6 +90,7 @@ that would constantly interact with the environment and tell it what to do.  Thi
         self.daemon = True
         self.sess = None
         self.summary_writer = None
+        self.recorder = recorder
 
     def start_runner(self, sess, summary_writer):
         self.sess = sess
@@ -92,7 +102,7 @@ that would constantly interact with the environment and tell it what to do.  Thi
             self._run()
 
     def _run(self):
-        rollout_provider = env_runner(self.env, self.policy, self.num_local_steps, self.summary_writer)
+        rollout_provider = env_runner(self.env, self.policy, self.num_local_steps, self.summary_writer, self.recorder)
         while True:
             # the timeout variable exists because apparently, if one worker dies, the other workers
             # won't die with it, unless the timeout is set to some large number.  This is an empirical
@@ -103,11 +113,12 @@ that would constantly interact with the environment and tell it what to do.  Thi
 
 
 
-def env_runner(env, policy, num_local_steps, summary_writer):
+def env_runner(env, policy, num_local_steps, summary_writer, recorder=None):
     """
 The logic of the thread runner.  In brief, it constantly keeps on running
 the policy, and as long as the rollout exceeds a certain length, the thread
-runner appends the policy to the queue.
+runner appends the policy to the queue.  If a recorder is given, every step
+is also appended to it.
 """
     last_state = env.reset()
     last_features = policy.get_initial_features()
@@ -121,8 +132,7 @@ runner appends the policy to the queue.
         for _ in range(num_local_steps):
             fetched = policy.act(last_state, *last_features)
             action, value_, features = fetched[0], fetched[1], fetched[2:]
-            # argmax to convert from one-hot
-            state, reward, terminal, info = env.step(action.argmax())
+            state, reward, terminal, info = env.step(action)
 
             # collect the experience
             rollout.add(last_state, action, reward, value_, terminal, last_features)
@@ -140,6 +150,9 @@ runner appends the policy to the queue.
                 summary_writer.flush()
 
             timestep_limit = env.spec.tags.get('wrapper_config.TimeLimit.max_episode_steps')
+            if recorder is not None:
+                recorder.add(rollout.states[-1], action, reward, value_[0],
+                             terminal or length >= timestep_limit)
             if terminal or length >= timestep_limit:
                 terminal_end = True
                 if length >= timestep_limit or not env.metadata.get('semantics.autoreset'):
@@ -157,29 +170,60 @@ runner appends the policy to the queue.
         yield rollout
 
 class A3C(object):
-    def __init__(self, env, task):
+    def __init__(self, env, task, inference_address=None, frozen_policy=False, record_dir=None, policy_config=None,
+                 accumulate_rollouts=None, accumulate_steps=None, optimizer='adam', distributed=True, shared=None):
         """
 An implementation of the A3C algorithm that is reasonably well-tuned for the VNC environments.
 Below, we will have a modest amount of complexity due to the way TensorFlow handles data parallelism.
 But overall, we'll define the model, specify its inputs, and describe how the policy gradients step
 should be computed.
+
+If inference_address is given, the runner acts through the shared inference server of the host
+rather than through its own copy of the policy.  If frozen_policy is set, the runner acts through
+a pruned copy of the local policy in a session of its own, whose weights are refreshed every time
+they are synced.
+
+If record_dir is given, all the experience of the runner is recorded there.  policy_config
+is the model.PolicyConfig of the architecture of the policy, an LSTMPolicy or an FFPolicy.
+
+If accumulate_rollouts or accumulate_steps is given, the gradients of consecutive rollouts are
+summed in local variables, and applied to the parameter server in one go once that many rollouts
+or environment steps have been accumulated.  The local weights are only synced after each apply.
+
+optimizer is 'adam', or 'rmsprop' for the shared RMSProp of the A3C paper.
+
+Unless distributed is set, no devices are assigned, and the A3C is one of several learner threads
+of a single process (see hogwild.py).  Those threads pass the A3C of the first thread as shared,
+to update its global network through its optimizer.
 """
 
         self.env = env
         self.task = task
-        worker_device = "/job:worker/task:{}/cpu:0".format(task)
-        with tf.device(tf.train.replica_device_setter(1, worker_device=worker_device)):
-            with tf.variable_scope("global"):
-                self.network = LSTMPolicy(env.observation_space.shape, env.action_space.n)
-                self.global_step = tf.get_variable("global_step", [], tf.int32, initializer=tf.constant_initializer(0, dtype=tf.int32),
-                                                   trainable=False)
+        if distributed:
+            worker_device = "/job:worker/task:{}/cpu:0".format(task)
+            global_device = tf.train.replica_device_setter(1, worker_device=worker_device)
+            local_scope = "local"
+        else:
+            worker_device = global_device = None
+            local_scope = "local{}".format(task)
+
+        if shared is None:
+            with tf.device(global_device):
+                with tf.variable_scope("global"):
+                    self.network = create_policy(env.observation_space.shape, env.action_space.n, policy_config)
+                    self.global_step = tf.get_variable("global_step", [], tf.int32, initializer=tf.constant_initializer(0, dtype=tf.int32),
+                                                       trainable=False)
+        else:
+            self.network = shared.network
+            self.global_step = shared.global_step
 
         with tf.device(worker_device):
-            with tf.variable_scope("local"):
-                self.local_network = pi = LSTMPolicy(env.observation_space.shape, env.action_space.n)
+            with tf.variable_scope(local_scope):
+                self.local_network = pi = create_policy(env.observation_space.shape, env.action_space.n, policy_config)
                 pi.global_step = self.global_step
 
-            self.ac = tf.placeholder(tf.float32, [None, env.action_space.n], name="ac")
+            # the indices of the actions taken
+            self.ac = tf.placeholder(tf.int32, [None], name="ac")
             self.adv = tf.placeholder(tf.float32, [None], name="adv")
             self.r = tf.placeholder(tf.float32, [None], name="r")
 
@@ -189,7 +233,10 @@ should be computed.
             # the "policy gradients" loss:  its derivative is precisely the policy gradient
             # notice that self.ac is a placeholder that is provided externally.
             # adv will contain the advantages, as calculated in process_rollout
-            pi_loss = - tf.reduce_sum(tf.reduce_sum(log_prob_tf * self.ac, [1]) * self.adv)
+            # the sparse cross entropy is minus the log probability of the action taken, gathered
+            # by index, rather than summed over a one-hot mask of all the actions
+            neg_log_prob_ac = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=pi.logits, labels=self.ac)
+            pi_loss = tf.reduce_sum(neg_log_prob_ac * self.adv)
 
             # loss of value function
             vf_loss = 0.5 * tf.reduce_sum(tf.square(pi.vf - self.r))
@@ -204,16 +251,31 @@ should be computed.
             # on the one hand;  but on the other hand, we get less frequent parameter updates, which
             # slows down learning.  In this code, we found that making local steps be much
             # smaller than 20 makes the algorithm more difficult to tune and to get to work.
-            self.runner = RunnerThread(env, pi, 20)
+            recorder = None
+            if record_dir is not None:
+                recorder = TrajectoryRecorder(record_dir, env.observation_space.shape, env.action_space.n)
+
+            assert inference_address is None or not frozen_policy
+            self.frozen_policy = None
+            if inference_address is not None:
+                self.runner = RunnerThread(env, RemotePolicy(inference_address, pi), 20, recorder)
+            elif frozen_policy:
+                self.frozen_policy = FrozenPolicy(pi)
+                self.frozen_policy.global_step = self.global_step
+                self.runner = RunnerThread(env, self.frozen_policy, 20, recorder)
+            else:
+                self.runner = RunnerThread(env, pi, 20, recorder)
 
 
             grads = tf.gradients(self.loss, pi.var_list)
 
+            # the newest frame of every stacked observation
+            frame = pi.x[:, :, :, -(pi.ob_space[-1] // pi.config.frames):]
             if use_tf12_api:
                 tf.summary.scalar("model/policy_loss", pi_loss / bs)
                 tf.summary.scalar("model/value_loss", vf_loss / bs)
                 tf.summary.scalar("model/entropy", entropy / bs)
-                tf.summary.image("model/state", pi.x)
+                tf.summary.image("model/state", frame)
                 tf.summary.scalar("model/grad_global_norm", tf.global_norm(grads))
                 tf.summary.scalar("model/var_global_norm", tf.global_norm(pi.var_list))
                 self.summary_op = tf.summary.merge_all()
@@ -222,26 +284,62 @@ should be computed.
                 tf.scalar_summary("model/policy_loss", pi_loss / bs)
                 tf.scalar_summary("model/value_loss", vf_loss / bs)
                 tf.scalar_summary("model/entropy", entropy / bs)
-                tf.image_summary("model/state", pi.x)
+                tf.image_summary("model/state", frame)
                 tf.scalar_summary("model/grad_global_norm", tf.global_norm(grads))
                 tf.scalar_summary("model/var_global_norm", tf.global_norm(pi.var_list))
                 self.summary_op = tf.merge_all_summaries()
 
-            grads, _ = tf.clip_by_global_norm(grads, 40.0)
-
             # copy weights from the parameter server to the local model
             self.sync = tf.group(*[v1.assign(v2) for v1, v2 in zip(pi.var_list, self.network.var_list)])
 
-            grads_and_vars = list(zip(grads, self.network.var_list))
-            inc_step = self.global_step.assign_add(tf.shape(pi.x)[0])
-
-            # each worker has a different set of adam optimizer parameters
-            opt = tf.train.AdamOptimizer(1e-4)
-            self.train_op = tf.group(opt.apply_gradients(grads_and_vars), inc_step)
+            # The slots of the optimizer are created next to the global variables, on the ps, and under
+            # the same names by every worker, so all the workers share a single set of optimizer statistics:
+            # the ps holds one copy of them however many workers there are.  Threads of a single process
+            # share the optimizer object itself, which keeps one set of slots per variable.
+            if shared is not None:
+                opt = shared.opt
+            elif optimizer == 'rmsprop':
+                opt = tf.train.RMSPropOptimizer(7e-4, decay=0.99, epsilon=0.1)
+            else:
+                assert optimizer == 'adam', optimizer
+                opt = tf.train.AdamOptimizer(1e-4)
+            self.opt = opt
+
+            self.accumulate_rollouts = accumulate_rollouts
+            self.accumulate_steps = accumulate_steps
+            self.accumulated_rollouts = 0
+            self.accumulated_steps = 0
+            if accumulate_rollouts or accumulate_steps:
+                # the accumulators are local variables, so that every worker initializes its own,
+                # and they are not saved in checkpoints
+                with tf.variable_scope(local_scope), tf.variable_scope("accumulators"):
+                    accums = [tf.get_variable("grad{}".format(i), v.get_shape(), initializer=tf.constant_initializer(0.0),
+                                              trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                              for i, v in enumerate(pi.var_list)]
+                    accum_steps = tf.get_variable("steps", [], tf.int32, initializer=tf.constant_initializer(0, dtype=tf.int32),
+                                                  trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                self.train_op = tf.group(*[a.assign_add(g) for a, g in zip(accums, grads)] +
+                                         [accum_steps.assign_add(tf.shape(pi.x)[0])])
+
+                # the sum is clipped as a whole, like the gradient of one long rollout would be
+                accum_grads, self.accum_norm = tf.clip_by_global_norm(accums, 40.0)
+                apply_op = tf.group(opt.apply_gradients(list(zip(accum_grads, self.network.var_list))),
+                                    self.global_step.assign_add(accum_steps))
+                with tf.control_dependencies([apply_op]):
+                    self.apply_op = tf.group(*[a.assign(tf.zeros_like(a)) for a in accums] + [accum_steps.assign(0)])
+            else:
+                grads, _ = tf.clip_by_global_norm(grads, 40.0)
+                grads_and_vars = list(zip(grads, self.network.var_list))
+                inc_step = self.global_step.assign_add(tf.shape(pi.x)[0])
+                self.train_op = tf.group(opt.apply_gradients(grads_and_vars), inc_step)
             self.summary_writer = None
             self.local_steps = 0
+            self.env_steps = 0
 
     def start(self, sess, summary_writer):
+        if self.frozen_policy is not None:
+            sess.run(self.sync)
+            self.frozen_policy.refresh(sess)
         self.runner.start_runner(sess, summary_writer)
         self.summary_writer = summary_writer
 
@@ -264,9 +362,13 @@ and updates the parameters.  The update is then sent to the parameter
 server.
 """
 
-        sess.run(self.sync)  # copy weights from shared to local
+        if self.accumulated_rollouts == 0:
+            sess.run(self.sync)  # copy weights from shared to local
+            if self.frozen_policy is not None:
+                self.frozen_policy.refresh(sess)
         rollout = self.pull_batch_from_queue()
         batch = process_rollout(rollout, gamma=0.99, lambda_=1.0)
+        self.env_steps += len(batch.a)
 
         should_compute_summary = self.task == 0 and self.local_steps % 11 == 0
 
@@ -280,9 +382,9 @@ server.
             self.ac: batch.a,
             self.adv: batch.adv,
             self.r: batch.r,
-            self.local_network.state_in[0]: batch.features[0],
-            self.local_network.state_in[1]: batch.features[1],
         }
+        # the state of the policy at the start of the rollout (a policy without state has none)
+        feed_dict.update(zip(self.local_network.state_in, batch.features))
 
         fetched = sess.run(fetches, feed_dict=feed_dict)
 
@@ -290,3 +392,21 @@ server.
             self.summary_writer.add_summary(tf.Summary.FromString(fetched[0]), fetched[-1])
             self.summary_writer.flush()
         self.local_steps += 1
+
+        if self.accumulate_rollouts or self.accumulate_steps:
+            self.accumulated_rollouts += 1
+            self.accumulated_steps += len(batch.a)
+            if (self.accumulate_rollouts and self.accumulated_rollouts >= self.accumulate_rollouts) or \
+                    (self.accumulate_steps and self.accumulated_steps >= self.accumulate_steps):
+                self.apply_accumulated(sess)
+
+    def apply_accumulated(self, sess):
+        norm, _, global_step = sess.run([self.accum_norm, self.apply_op, self.global_step])
+        summary = tf.Summary()
+        summary.value.add(tag="model/effective_batch_rollouts", simple_value=float(self.accumulated_rollouts))
+        summary.value.add(tag="model/effective_batch_steps", simple_value=float(self.accumulated_steps))
+        summary.value.add(tag="model/accumulated_grad_norm", simple_value=float(norm))
+        self.summary_writer.add_summary(summary, global_step)
+        self.summary_writer.flush()
+        self.accumulated_rollouts = 0
+        self.accumulated_steps = 0
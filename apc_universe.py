@@ -3,7 +3,13 @@ from __future__ import print_function
 import argparse
 import os
 import subprocess
-from multiprocessing import Pool
+import sys
+import threading
+import time
+from collections import namedtuple
+from functools import partial
+
+from dag import DagExecutor, Step
 from future.moves.html.parser import HTMLParser
 
 
@@ -42,15 +48,45 @@ class _HtmlTableParser(HTMLParser):
         return [dict(zip(self.table_headers, row)) for row in self.table_row]
 
 
+NamespaceListing = namedtuple('NamespaceListing', ['jobs', 'job_states', 'networks', 'services'])
+
+
 class ApceraApi(object):
-    def __init__(self, apc='apc', verbose=False):
+    """
+Thin wrapper around the apc command line.  The parsed output of read commands is cached for
+`cache_ttl` seconds, and the whole cache is dropped by every mutating call.  A read that overlaps
+a mutating call is not cached, since it may have seen the state before the mutation.  The target
+and the namespace come from the same `apc target` call, and are cached until
+`invalidate(target=True)`.  namespace_listing reads the jobs, networks and services together.
+"""
+    def __init__(self, apc='apc', verbose=False, cache_ttl=30.0):
         self.apc = apc
+        self.cache_ttl = cache_ttl
+        self._cache = {}
+        self._target_info = None
+        self._lock = threading.Lock()
+        # bumped at the start and at the end of every mutating call, and the number of them in flight
+        self._generation = 0
+        self._mutations = 0
         if verbose:
             self.stdout = None
         else:
             self.stdout = open(os.devnull, 'w')
 
+    def invalidate(self, target=False):
+        with self._lock:
+            self._cache = {}
+            if target:
+                self._target_info = None
+
     def _apc_output(self, cmd, table=True):
+        key = (cmd, table)
+        with self._lock:
+            cached = self._cache.get(key)
+            generation = self._generation
+        if cached is not None and time.time() - cached[0] < self.cache_ttl:
+            return cached[1]
+
         try:
             output = subprocess.check_output([self.apc] + cmd.split() + ['--html', '--batch']).decode("utf-8")
         except subprocess.CalledProcessError:
@@ -59,9 +95,30 @@ class ApceraApi(object):
         if table:
             parser = _HtmlTableParser()
             parser.feed(output)
-            return parser.get_table()
-        else:
-            return output
+            output = parser.get_table()
+        with self._lock:
+            if self._generation == generation and self._mutations == 0:
+                self._cache[key] = (time.time(), output)
+        return output
+
+    def _apc_outputs(self, cmds):
+        """The outputs of several read commands, run concurrently so that together they cost one round trip."""
+        outputs = {}
+
+        def read(cmd):
+            outputs[cmd] = self._apc_output(cmd)
+        threads = [threading.Thread(target=read, args=(cmd,)) for cmd in cmds]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [outputs[cmd] for cmd in cmds]
+
+    def _mutation(self, started):
+        with self._lock:
+            self._generation += 1
+            self._mutations += 1 if started else -1
+            self._cache = {}
 
     def _apc(self, cmd, as_batch=True):
         if isinstance(cmd, str):
@@ -72,7 +129,12 @@ class ApceraApi(object):
             cmd += ['--batch']
 
         print("\033[92m[Calling]:\033[m", ' '.join(cmd))
-        return subprocess.call(cmd, stdout=self.stdout)
+        # the cache is dropped both before and after the call, and reads that overlap it are not cached
+        self._mutation(started=True)
+        try:
+            return subprocess.call(cmd, stdout=self.stdout)
+        finally:
+            self._mutation(started=False)
 
     def docker_run(self, instance_name, image, args=None, docker_opt='-ae', memory=None):
         memory = '-m ' + str(memory) if memory else ''
@@ -112,6 +174,11 @@ class ApceraApi(object):
     def jobs(self):
         return [job['Name'] for job in self._apc_output('job list')]
 
+    @property
+    def job_states(self):
+        """Maps every job to its state, or to None if apc does not report states."""
+        return dict((job['Name'], job.get('State')) for job in self._apc_output('job list'))
+
     def job_start(self, instance_name):
         return self._apc('job start {name}'.format(name=instance_name))
 
@@ -141,28 +208,58 @@ class ApceraApi(object):
         return self._apc('route add {route} -p {port} --app {job}'.format(route=route,
                                                                           port=port,
                                                                           job=job))
-    @property
-    def target(self):
+    def _target(self):
         # Unfortunatly target does not support html output
+        with self._lock:
+            if self._target_info is not None:
+                return self._target_info
+        target, namespace = None, None
         for line in self._apc_output('target', table=False).split('\n'):
-            if 'Targeted' in line:
-                return line[line.find('https://') + len('https://'):line.find(']')]
+            if target is None and 'Targeted' in line:
+                target = line[line.find('https://') + len('https://'):line.find(']')]
+            if namespace is None and 'namespace' in line:
+                namespace = line[line.find('\"') + 1:line.rfind('\"')]
+        with self._lock:
+            self._target_info = (target, namespace)
+        return self._target_info
+
+    @property
+    def target(self):
+        return self._target()[0]
 
     @property
     def namespace(self):
-        # Unfortunatly target does not support html output
-        for line in self._apc_output('target', table=False).split('\n'):
-            if 'namespace' in line:
-                return line[line.find('\"') + 1:line.rfind('\"')]
+        return self._target()[1]
+
+    def namespace_listing(self):
+        """The jobs (and their states), networks and services of the namespace, read together."""
+        jobs, networks, services = self._apc_outputs(['job list', 'network list', 'service list'])
+        return NamespaceListing(jobs=[job['Name'] for job in jobs],
+                                job_states=dict((job['Name'], job.get('State')) for job in jobs),
+                                networks=[nw['Network Name'] for nw in networks],
+                                services=[service['Name'] for service in services])
+
+    def namespace_clear_steps(self):
+        """The steps of namespace_clear, for running on a DagExecutor."""
+        jobs, _, networks, services = self.namespace_listing()
+        steps = [Step('delete ' + job, partial(self.job_delete, job)) for job in jobs]
+        job_steps = [step.name for step in steps]
+        steps += [Step('delete network ' + network, partial(self.network_delete, network), deps=job_steps)
+                  for network in networks]
+        steps += [Step('delete service ' + service, partial(self.service_delete, service), deps=job_steps)
+                  for service in services]
+        return steps
 
     def namespace_clear(self):
-        for job in self.jobs:
+        # list everything before deleting anything, since every delete drops the cache
+        jobs, _, networks, services = self.namespace_listing()
+        for job in jobs:
             self.job_delete(job)
 
-        for network in self.networks:
+        for network in networks:
             self.network_delete(network)
 
-        for service in self.services:
+        for service in services:
             self.service_delete(service)
 
 
@@ -184,60 +281,148 @@ class Deployment(object):
         self.log_dir = log_dir
         self.grpc_port = grpc_port
         self.gym_ports = gym_ports
+        self._cluster_spec = None
+        self._domain = None
 
     @property
     def cluster_spec(self):
-        ps = [self.get_discovery_address('ps0') + ':' + str(self.grpc_port)]
-        workers = [self.get_discovery_address(inst['worker']) + ':' + str(self.grpc_port) for inst in self.instances]
-        gyms = [self.get_discovery_address(inst['gym']) for inst in self.instances]
-
-        return {'ps': ps, 'worker': workers, 'gym': gyms}
+        # the instances never change after construction, so neither does the spec
+        if self._cluster_spec is None:
+            ps = [self.get_discovery_address('ps0') + ':' + str(self.grpc_port)]
+            workers = [self.get_discovery_address(inst['worker']) + ':' + str(self.grpc_port) for inst in self.instances]
+            gyms = [self.get_discovery_address(inst['gym']) for inst in self.instances]
+            self._cluster_spec = {'ps': ps, 'worker': workers, 'gym': gyms}
+        return self._cluster_spec
 
     @property
     def cluster_spec_flat(self):
         return ','.join(self.cluster_spec['ps'] + self.cluster_spec['worker'])
 
     def get_domain(self, job):
-        return '{job}.{namespace}{domain}'.format(job=job,
-                                                  namespace='.'.join(reversed(self.apc.namespace.split('/'))),
-                                                  domain=self.apc.target)
+        if self._domain is None:
+            self._domain = '{namespace}{domain}'.format(namespace='.'.join(reversed(self.apc.namespace.split('/'))),
+                                                        domain=self.apc.target)
+        return '{job}.{domain}'.format(job=job, domain=self._domain)
 
     def get_discovery_address(self, job):
         return '{job}.apcera.local'.format(job=job)
 
-    def deploy(self):
-        self.apc.namespace_clear()
-
-        self.apc.network_create(self.deployment_name)
-
-        self.create_instances()
-
-        # We need to join the network rather than adding -net to docker run
-        # This is due to that we want --discovery-address (which is only available on network join
-        for job in self.apc.jobs:
-            self.apc.network_join(self.deployment_name, job)
-
-        # We need to attrct jobs manually since attract is only available as a job operation rather
-        # than as part of a create procedure
-        for inst in self.instances:
-            self.apc.job_attract(inst['worker'], inst['gym'])
+    def deploy(self, concurrency=8, retries=2):
+        """
+Clears the namespace and brings up the cluster.  Every apc call is a step of a dependency
+graph, run by a DagExecutor with at most `concurrency` calls in flight.  Returns the names
+of the steps that failed.
+"""
+        clear_steps = self.apc.namespace_clear_steps()
+        steps = clear_steps + self.deploy_steps(after=[step.name for step in clear_steps])
+
+        executor = DagExecutor(max_workers=concurrency, retries=retries)
+        failed = executor.run(steps)
+        executor.report()
+        return failed
+
+    def reconcile(self, concurrency=8, retries=2, restart_training=False):
+        """
+Brings the namespace to the desired set of instances without tearing down what is already
+right: missing jobs are created and started, jobs that are no longer wanted are deleted, and
+jobs that exist but are not running are started again.  The ps and healthy workers keep running.
+
+Worker task indices are positions in the instance list, so instances should only be added to
+or removed from the end of the list.  Removing workers is safe, but the ps only knows the workers
+of the --workers list it was started with, and it dials a worker back for every gradient the
+worker applies (see worker.py).  Adding workers to a running session therefore needs
+`restart_training`: the ps and all the workers are then deleted and created again with the new
+list, and resume from the last checkpoint in log_dir, while the gyms keep running.  Without it,
+adding workers to a running session raises a ValueError.
+"""
+        desired = [spec['name'] for spec in self.instance_specs()]
+        listing = self.apc.namespace_listing()
+        existing = listing.job_states
+        workers = [inst['worker'] for inst in self.instances]
+        ps = [spec['name'] for spec in self.instance_specs() if spec['name'].startswith('ps')]
+        to_delete = [job for job in existing if job not in desired]
+        to_create = [job for job in desired if job not in existing]
+        to_recreate = []
+        if any(job in workers for job in to_create) and any(job in existing for job in ps):
+            if not restart_training:
+                raise ValueError('Adding workers to the running session would leave them unknown to its ps, '
+                                 'reconcile with restart_training to restart the ps and the workers')
+            to_recreate = [job for job in ps + workers if job in existing]
+        to_start = [job for job in desired
+                    if job in existing and job not in to_recreate and existing[job] not in (None, 'started')]
+        print('Reconciling: {} to create, {} to delete, {} to recreate, {} to restart, {} unchanged'.format(
+            len(to_create), len(to_delete), len(to_recreate), len(to_start),
+            len(desired) - len(to_create) - len(to_recreate) - len(to_start)))
+
+        steps = [Step('delete ' + job, partial(self.apc.job_delete, job)) for job in to_delete + to_recreate]
+        steps += self.deploy_steps(after=['delete ' + job for job in to_recreate], jobs=to_create + to_recreate,
+                                   create_network=self.deployment_name not in listing.networks,
+                                   create_nfs_service=self._get_nfs_service_name() not in listing.services)
+        steps += [Step('start ' + job, partial(self.apc.job_start, job)) for job in to_start]
+
+        executor = DagExecutor(max_workers=concurrency, retries=retries)
+        failed = executor.run(steps)
+        if steps:
+            executor.report()
+        return failed
+
+    def deploy_steps(self, after=(), jobs=None, create_network=True, create_nfs_service=True):
+        """
+The steps that create and start `jobs` (all the jobs of the deployment by default), each
+depending on the steps named in `after`.
+"""
+        nfs_service = self._get_nfs_service_name()
+        steps = []
+        nfs_deps, network_deps = [], []
+        if create_network:
+            steps += [Step('create network', partial(self.apc.network_create, self.deployment_name), deps=after)]
+            network_deps = ['create network']
+        if create_nfs_service:
+            steps += [Step('create nfs service', partial(self.create_nfs_service, nfs_service), deps=after)]
+            nfs_deps = ['create nfs service']
 
-        self.start_jobs()
+        workers = [inst['worker'] for inst in self.instances]
+        gym_of = dict((inst['worker'], inst['gym']) for inst in self.instances)
+        specs = [spec for spec in self.instance_specs() if jobs is None or spec['name'] in jobs]
+        names = [spec['name'] for spec in specs]
+        for spec in specs:
+            name = spec['name']
+            steps += [Step('create ' + name, partial(self.apc.docker_run, name, spec['image'], args=spec['args'],
+                                                     docker_opt=spec['docker_opt'], memory=spec['memory']), deps=after),
+                      Step('bind ' + name, partial(self.apc.service_bind, nfs_service, name,
+                                                   '--mountpath ' + self.log_dir),
+                           deps=['create ' + name] + nfs_deps),
+                      # We need to join the network rather than adding -net to docker run
+                      # This is due to that we want --discovery-address (which is only available on network join
+                      Step('join ' + name, partial(self.apc.network_join, self.deployment_name, name),
+                           deps=['create ' + name] + network_deps)]
+            if name in workers:
+                # We need to attrct jobs manually since attract is only available as a job operation rather
+                # than as part of a create procedure
+                gym = gym_of[name]
+                steps += [Step('attract ' + name, partial(self.apc.job_attract, name, gym),
+                               deps=['create ' + name] + (['create ' + gym] if gym in names else []))]
+
+        # the ps and the gyms are started before any of the workers
+        others = [name for name in names if name not in workers]
+        for name in others:
+            steps += [Step('start ' + name, partial(self.apc.job_start, name), deps=['bind ' + name, 'join ' + name])]
+        for name in names:
+            if name in workers:
+                steps += [Step('start ' + name, partial(self.apc.job_start, name),
+                               deps=['bind ' + name, 'join ' + name, 'attract ' + name] + ['start ' + o for o in others])]
+        return steps
 
     def create_nfs_service(self, name):
         nfs_providers = [provider for provider in self.apc.providers if provider['Type'] == 'nfs']
 
         assert len(nfs_providers) >= 1, 'No valid nfs providers found!'
         provider = nfs_providers[0]  # Take first valid provider
-        self.apc.service_create(name, provider['Namespace'] + '::' + provider['Name'])
+        return self.apc.service_create(name, provider['Namespace'] + '::' + provider['Name'])
 
-    def create_instances(self):
-        self.create_nfs_service(self._get_nfs_service_name())
-
-        pool = Pool(processes=(len(self.cluster_spec['gym']) +
-                               len(self.cluster_spec['ps']) +
-                               len(self.cluster_spec['worker'])))
-        pool_args = []
+    def instance_specs(self):
+        """The name, image and docker options of every job of the deployment."""
+        specs = []
         for inst in self.instances:
             name = inst['gym']
             tag = inst['tag']
@@ -247,13 +432,11 @@ class Deployment(object):
             docker_gym_opt = '--no-start --timeout 300 {tag} {port} {route}'.format(tag=tag,
                                                                                     port=ports,
                                                                                     route=route)
-            pool_args.append(dict(name=name,
-                                  image=self.gym_image,
-                                  args=None,
-                                  docker_opt=docker_gym_opt,
-                                  memory='1G',
-                                  nfs_service_name=self._get_nfs_service_name(),
-                                  log_dir=self.log_dir))
+            specs.append(dict(name=name,
+                              image=self.gym_image,
+                              args=None,
+                              docker_opt=docker_gym_opt,
+                              memory='1G'))
 
         worker_cmd = '/usr/bin/python /universe-starter-agent/worker.py '
         docker_worker_opt = '-ae --no-start -p {port} '.format(port=self.grpc_port)
@@ -270,13 +453,11 @@ class Deployment(object):
             args += '"'
             docker_ps_opt = '-p {port} -r http://{domain}'.format(domain=self.get_domain(name),
                                                                   port=tb_port)
-            pool_args.append(dict(name=name,
-                                  image=self.agent_image,
-                                  args=args,
-                                  docker_opt=docker_worker_opt + docker_ps_opt,
-                                  memory='1G',
-                                  nfs_service_name=self._get_nfs_service_name(),
-                                  log_dir=self.log_dir))
+            specs.append(dict(name=name,
+                              image=self.agent_image,
+                              args=args,
+                              docker_opt=docker_worker_opt + docker_ps_opt,
+                              memory='1G'))
 
         for i, inst in enumerate(self.instances):
             name = inst['worker']
@@ -287,63 +468,43 @@ class Deployment(object):
             args += '--workers {workers} '.format(workers=self.cluster_spec_flat)
             args += '--task {id_} '.format(id_=i)
             args += '--remotes vnc://{gym}:{ports}'.format(gym=self.cluster_spec['gym'][i], ports='+'.join(self.gym_ports))
-            docker_worker_opt += '-ht ' + tag if tag else ''
-            pool_args.append(dict(name=name,
-                                  image=self.agent_image,
-                                  args=args,
-                                  docker_opt=docker_worker_opt,
-                                  memory='1G',
-                                  nfs_service_name=self._get_nfs_service_name(),
-                                  log_dir=self.log_dir))
-        pool.map(_create_instance, pool_args)
-
-    def start_jobs(self):
-        pool1 = Pool(processes=len(self.apc.jobs))
-        pool1_args = []
-        pool2 = Pool(processes=len(self.apc.jobs))
-        pool2_args = []
-
-        workers = [inst['worker'] for inst in self.instances]
-        for job in self.apc.jobs:
-            if job not in workers:
-                pool1_args.append(job)
-            else:
-                pool2_args.append(job)
-        pool1.map(_start_apc_job, pool1_args)
-        pool2.map(_start_apc_job, pool2_args)
+            specs.append(dict(name=name,
+                              image=self.agent_image,
+                              args=args,
+                              docker_opt=docker_worker_opt + ('-ht ' + tag if tag else ''),
+                              memory='1G'))
+        return specs
 
     def _get_nfs_service_name(self):
         return self.deployment_name + '_nfs'
 
 
-def _create_instance(args):
-    apc = ApceraApi()
-    apc.docker_run(args['name'],
-                   args['image'],
-                   args=args['args'],
-                   docker_opt=args['docker_opt'],
-                   memory=args['memory'])
-    apc.service_bind(args['nfs_service_name'],
-                     args['name'],
-                     '--mountpath ' + args['log_dir'])
-
-
-def _start_apc_job(job):
-    apc = ApceraApi()
-    apc.job_start(job)
-
-
 def deploy(args):
-    depl = Deployment(args.env_id, args.instances, args.deployment, apc=ApceraApi(verbose=args.verbose))
-    depl.deploy()
+    depl = Deployment(args.env_id, args.instances, args.deployment, apc=ApceraApi(apc=args.apc, verbose=args.verbose))
+    if depl.deploy(concurrency=args.concurrency, retries=args.retries):
+        sys.exit(1)
+
+def reconcile(args):
+    depl = Deployment(args.env_id, args.instances, args.deployment, apc=ApceraApi(apc=args.apc, verbose=args.verbose))
+    try:
+        failed = depl.reconcile(concurrency=args.concurrency, retries=args.retries,
+                                restart_training=args.restart_training)
+    except ValueError as e:
+        sys.exit(str(e))
+    if failed:
+        sys.exit(1)
 
 def print_(args):
-    apc = ApceraApi()
+    apc = ApceraApi(apc=args.apc)
     print(apc.providers)
 
 def clean(args):
-    apc = ApceraApi()
-    apc.namespace_clear()
+    apc = ApceraApi(apc=args.apc, verbose=args.verbose)
+    executor = DagExecutor(max_workers=args.concurrency, retries=args.retries)
+    failed = executor.run(apc.namespace_clear_steps())
+    executor.report()
+    if failed:
+        sys.exit(1)
 
 class InstanceParser(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
@@ -361,6 +522,9 @@ def main():
 
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                         default=False, help='Verbose output')
+    parser.add_argument('--apc', default='apc', help='The apc executable (e.g. ./fake_apc.py for a local stand-in)')
+    parser.add_argument('-c', '--concurrency', default=8, type=int, help='Maximum number of apc calls in flight')
+    parser.add_argument('--retries', default=2, type=int, help='Number of times a failed apc call is retried')
 
     # Deploy
     parser_deploy = subparsers.add_parser('deploy', help='Deploys a cluster of RL agents')
@@ -372,6 +536,19 @@ def main():
                                     'pairs of instance names and their tags vehicle1:plano vehicle2:sj'))
     parser_deploy.set_defaults(func=deploy)
 
+    # Reconcile
+    parser_reconcile = subparsers.add_parser('reconcile', help=('Creates, deletes or restarts only the jobs that '
+                                                                'differ from the given instances'))
+    parser_reconcile.add_argument('-e', '--env-id', default='flashgames.DuskDrive-v0')
+    parser_reconcile.add_argument('-d', '--deployment', default='universe', help='An arbitrary deployment name')
+    parser_reconcile.add_argument('--restart-training', action='store_true', default=False,
+                                  help=('Allow adding workers to a running session by restarting its ps and '
+                                        'workers, which resume from the last checkpoint'))
+    parser_reconcile.add_argument('instances', nargs='*', default=['4'], action=InstanceParser,
+                                  help=('Can optionally be a number, OR '
+                                        'pairs of instance names and their tags vehicle1:plano vehicle2:sj'))
+    parser_reconcile.set_defaults(func=reconcile)
+
     # Print
     parser_print = subparsers.add_parser('print')
     parser_print.set_defaults(func=print_)
@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the actor and learner paths.  Every measurement runs in a fresh
+process so that the memory numbers of one path are not polluted by the others.
+"""
+from __future__ import print_function
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+import numpy as np
+from memtrack import rss_mb, peak_rss_mb
+
+
+def tree_rss_mb(pid):
+    """Resident set size of a process and all of its descendants, in MB."""
+    children = {}
+    for stat in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat.split('/')[2]))
+    total, pending = 0.0, [pid]
+    while pending:
+        p = pending.pop()
+        try:
+            total += rss_mb(p)
+        except (IOError, OSError):
+            continue
+        pending += children.get(p, [])
+    return total
+
+
+def local_cluster(port=12300):
+    """
+An in-process ps + worker pair, so that the graphs are built and placed exactly as in worker.py.
+"""
+    import tensorflow as tf
+    cluster = tf.train.ClusterSpec({'ps': ['localhost:%d' % port], 'worker': ['localhost:%d' % (port + 1)]})
+    tf.train.Server(cluster, job_name="ps", task_index=0, config=tf.ConfigProto(device_filters=["/job:ps"]))
+    return tf.train.Server(cluster, job_name="worker", task_index=0,
+                           config=tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=2))
+
+
+def fake_env(ob_shape, num_actions):
+    """Just enough of an env to build the A3C graph; it is never stepped."""
+    Space = namedtuple('Space', ['shape', 'n'])
+    Env = namedtuple('Env', ['observation_space', 'action_space'])
+    return Env(Space(tuple(ob_shape), None), Space(None, num_actions))
+
+
+def time_act(policy, ob_shape, steps):
+    ob = np.random.rand(*ob_shape).astype(np.float32)
+    features = policy.get_initial_features()
+    for _ in range(10):
+        features = policy.act(ob, *features)[2:]
+    latencies = []
+    for _ in range(steps):
+        start = time.time()
+        features = policy.act(ob, *features)[2:]
+        latencies.append(time.time() - start)
+    latencies = np.asarray(latencies) * 1000.
+    return {'act_ms_mean': float(latencies.mean()),
+            'act_ms_p50': float(np.percentile(latencies, 50)),
+            'act_ms_p99': float(np.percentile(latencies, 99))}
+
+
+class SequenceActor(object):
+    """Acts through the dynamic_rnn sequence path of a policy, as LSTMPolicy.act used to."""
+    def __init__(self, policy):
+        self.policy = policy
+
+    def get_initial_features(self):
+        return self.policy.get_initial_features()
+
+    def act(self, ob, *features):
+        import tensorflow as tf
+        pi = self.policy
+        feed = {pi.x: [ob]}
+        feed.update(zip(pi.state_in, features))
+        return tf.get_default_session().run([pi.sample, pi.vf] + pi.state_out, feed)
+
+
+# the number of steps of a rollout of A3C, between two refreshes of the frozen policy
+ROLLOUT_STEPS = 20
+
+
+def act_path(args):
+    import tensorflow as tf
+    from a3c import A3C, use_tf12_api
+    from model import PolicyConfig, DEFAULT_POLICY_CONFIG
+
+    rss_before = rss_mb()
+    server = local_cluster()
+    ob_shape, policy_config = args.ob_shape, None
+    if args.path == 'ff':
+        ob_shape = ob_shape[:-1] + [ob_shape[-1] * 4]
+        policy_config = PolicyConfig(*DEFAULT_POLICY_CONFIG)._replace(policy='ff', frames=4)
+    trainer = A3C(fake_env(ob_shape, args.num_actions), 0, frozen_policy=(args.path == 'frozen'),
+                  policy_config=policy_config)
+    sess = tf.Session(server.target)
+    sess.run(tf.global_variables_initializer() if use_tf12_api else tf.initialize_all_variables())
+    sess.run(trainer.sync)
+
+    with sess.as_default():
+        if args.path == 'frozen':
+            # the first refresh builds the copy, the others only assign the weights, once per rollout
+            start = time.time()
+            trainer.frozen_policy.refresh(sess)
+            build_ms = (time.time() - start) * 1000.
+            refresh_ms = []
+            for _ in range(20):
+                start = time.time()
+                trainer.frozen_policy.refresh(sess)
+                refresh_ms.append((time.time() - start) * 1000.)
+            result = time_act(trainer.frozen_policy, args.ob_shape, args.steps)
+            graph_act_ms = time_act(trainer.local_network, args.ob_shape, args.steps)['act_ms_mean']
+            result.update({'build_ms': build_ms, 'refresh_ms': float(np.mean(refresh_ms)),
+                           'graph_act_ms_mean': graph_act_ms,
+                           'net_saved_ms_per_rollout': ROLLOUT_STEPS * (graph_act_ms - result['act_ms_mean'])
+                                                       - float(np.mean(refresh_ms))})
+            trainer.frozen_policy.close()
+        elif args.path == 'rnn':
+            result = time_act(SequenceActor(trainer.local_network), args.ob_shape, args.steps)
+        else:
+            result = time_act(trainer.local_network, ob_shape, args.steps)
+    result.update({'path': args.path, 'rss_mb': rss_mb() - rss_before, 'peak_rss_mb': peak_rss_mb()})
+    return result
+
+
+def serve_ps(cluster):
+    import tensorflow as tf
+    tf.train.Server(tf.train.ClusterSpec(cluster), job_name="ps", task_index=0,
+                    config=tf.ConfigProto(device_filters=["/job:ps"]))
+    while True:
+        time.sleep(1000)
+
+
+def ps_path(args):
+    """
+Builds the graphs of --num-workers workers against a ps of its own process, lets every worker
+apply one gradient with the given optimizer, and reports how the memory of the ps grows.  The
+workers share a single worker server here, which makes no difference to the ps.
+"""
+    cluster = {'ps': ['localhost:12310'], 'worker': ['localhost:12311']}
+    # start the ps before tensorflow is imported in this process
+    ps = multiprocessing.Process(target=serve_ps, args=(cluster,))
+    ps.daemon = True
+    ps.start()
+
+    import tensorflow as tf
+    from a3c import A3C, use_tf12_api
+    server = tf.train.Server(tf.train.ClusterSpec(cluster), job_name="worker", task_index=0)
+    env = fake_env(args.ob_shape, args.num_actions)
+    num_steps = 20
+    feed_values = [np.random.rand(*([num_steps] + args.ob_shape)).astype(np.float32),
+                   np.random.randint(args.num_actions, size=num_steps).astype(np.int32),
+                   np.random.randn(num_steps), np.random.randn(num_steps)]
+
+    ps_rss, apply_ms = [], []
+    for i in range(args.num_workers):
+        graph = tf.Graph()
+        with graph.as_default():
+            trainer = A3C(env, 0, optimizer=args.path)
+            init = tf.global_variables_initializer() if use_tf12_api else tf.initialize_all_variables()
+            with tf.Session(server.target) as sess:
+                if i == 0:
+                    sess.run(init)
+                sess.run(trainer.sync)
+                pi = trainer.local_network
+                feed = dict(zip([pi.x, trainer.ac, trainer.adv, trainer.r], feed_values))
+                feed.update(zip(pi.state_in, pi.get_initial_features()))
+                start = time.time()
+                sess.run(trainer.train_op, feed)
+                apply_ms.append((time.time() - start) * 1000.)
+        ps_rss.append(rss_mb(ps.pid))
+    ps.terminate()
+    return {'path': args.path, 'num_workers': args.num_workers,
+            'ps_rss_mb_first_worker': ps_rss[0], 'ps_rss_mb': ps_rss[-1],
+            'ps_rss_mb_per_extra_worker': (ps_rss[-1] - ps_rss[0]) / max(1, args.num_workers - 1),
+            'train_ms_mean': float(np.mean(apply_ms[1:] or apply_ms))}
+
+
+def training_path(args, worker_args=()):
+    """
+Trains on the synthetic env with --num-workers workers, either as the ps and worker processes
+train.py launches (with worker_args added to the command of every worker) or as the threads of a
+single hogwild.py process, and reports the total memory of all the processes and the env steps
+per second summed over the workers.
+"""
+    import train
+    from supervisor import status_path, read_status
+
+    logdir = tempfile.mkdtemp()
+    env_id = 'synthetic.flash' if args.ob_shape[0] == 128 else 'synthetic'
+    if args.path == 'hogwild':
+        cmds = [[sys.executable, 'hogwild.py', '--num-workers', str(args.num_workers), '--env-id', env_id,
+                 '--log-dir', logdir, '--status-interval', '5']]
+    else:
+        cmds = [cmd + ['--status-interval', '5'] for _, cmd in
+                train.create_process_cmds(args.num_workers + 1, None, None, env_id, logdir, worker_args=worker_args)]
+    procs = [subprocess.Popen(' '.join(cmd), shell=True, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT,
+                              preexec_fn=os.setsid) for cmd in cmds]
+
+    def env_steps():
+        statuses = [read_status(status_path(logdir, 'w-%d' % i)) for i in range(args.num_workers)]
+        return None if None in statuses else sum(s['env_steps'] for s in statuses)
+    try:
+        # wait until every worker has reported once after warming up
+        deadline = time.time() + 300
+        while env_steps() is None and time.time() < deadline:
+            time.sleep(1.0)
+        start_steps, start = env_steps() or 0, time.time()
+        time.sleep(args.seconds)
+        steps_per_sec = ((env_steps() or 0) - start_steps) / (time.time() - start)
+        rss = sum(tree_rss_mb(proc.pid) for proc in procs)
+    finally:
+        for proc in procs:
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for proc in procs:
+            proc.wait()
+        shutil.rmtree(logdir, ignore_errors=True)
+    return {'path': args.path, 'num_workers': args.num_workers, 'rss_mb': rss, 'env_steps_per_sec': steps_per_sec}
+
+
+# the worker.py flags of the policies compared by the policy benchmark
+POLICY_ARGS = {
+    'lstm': [],
+    'ff': ['--policy', 'ff', '--frame-stack', '4'],
+}
+
+
+def policy_path(args):
+    """The training benchmark of the distributed mode, with an LSTMPolicy or an FFPolicy on 4 stacked frames."""
+    return training_path(args, POLICY_ARGS[args.path])
+
+
+def atari_path(args):
+    """
+Steps an atari env with either backend.  Then steps an env of each backend with the same seed and
+the same actions, and checks that they return the same observations, rewards and episode ends.
+"""
+    from envs import create_atari_env
+
+    env = create_atari_env(args.atari_env_id, atari_backend=args.path)
+    env.reset()
+    start = time.time()
+    for _ in range(args.steps):
+        _, _, done, _ = env.step(env.action_space.sample())
+        if done:
+            env.reset()
+    elapsed = time.time() - start
+    env.close()
+
+    pair = [create_atari_env(args.atari_env_id, atari_backend=backend) for backend in ['rgb', 'ale']]
+    for e in pair:
+        # seeds the emulator and the frame skipping of gym's atari env
+        e.unwrapped.seed(0)
+    observations = [e.reset() for e in pair]
+    max_abs_diff = float(np.abs(observations[0] - observations[1]).max())
+    rng = np.random.RandomState(0)
+    for _ in range(1000):
+        action = rng.randint(pair[0].action_space.n)
+        (ob_rgb, reward_rgb, done_rgb, _), (ob_ale, reward_ale, done_ale, _) = [e.step(action) for e in pair]
+        max_abs_diff = max(max_abs_diff, float(np.abs(ob_rgb - ob_ale).max()))
+        assert (reward_rgb, done_rgb) == (reward_ale, done_ale), 'the backends diverged'
+        if done_rgb:
+            max_abs_diff = max(max_abs_diff, float(np.abs(pair[0].reset() - pair[1].reset()).max()))
+    for e in pair:
+        e.close()
+    assert max_abs_diff == 0.0, 'the ale backend is off by {} from the rgb backend'.format(max_abs_diff)
+    return {'path': args.path, 'step_ms': elapsed * 1000. / args.steps, 'max_abs_diff': max_abs_diff,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def flash_frames(n, height=768, width=1024):
+    """Blocky random screens, closer to rendered flash frames than per-pixel noise."""
+    import cv2
+    return [cv2.resize(np.random.randint(0, 256, (height // 8, width // 8, 3)).astype(np.uint8),
+                       (width, height), interpolation=cv2.INTER_NEAREST) for _ in range(n)]
+
+
+def flash_path(args):
+    from envs import _process_frame_flash, _process_frame_flash_fused, FLASH_FUSED_TOLERANCE
+
+    frames = flash_frames(args.batch)
+    height, width, top, left = 512, 800, 84, 18
+    gray = np.empty((height, width), np.float32)
+
+    def separate(frame):
+        return _process_frame_flash(frame[top:top+height, left:left+width, :])
+
+    def fused(frame):
+        return _process_frame_flash_fused(frame, top, left, gray)
+
+    process = fused if args.path == 'fused' else separate
+    start = time.time()
+    for _ in range(args.steps):
+        observation_n = [process(frame) for frame in frames]
+    elapsed = time.time() - start
+
+    reference = [separate(frame) for frame in frames]
+    diff = np.abs(np.asarray(observation_n) - np.asarray(reference))
+    assert diff.max() <= FLASH_FUSED_TOLERANCE, \
+        'the fused path is off by {} (more than {})'.format(diff.max(), FLASH_FUSED_TOLERANCE)
+    return {'path': args.path, 'frame_ms': elapsed * 1000. / (args.steps * args.batch),
+            'max_abs_diff': float(diff.max()), 'mean_abs_diff': float(diff.mean()),
+            'peak_rss_mb': peak_rss_mb()}
+
+
+class LinkModelSession(object):
+    """
+Stands in for the go VNC driver of one or more remotes behind a link of `bandwidth` bytes per second
+and `latency` seconds.  Like a VNC server, each remote only sends a new frame once the link has finished
+sending the previous one.  A frame costs the size of its grayscale JPEG at the fine_quality_level of the
+connection.  This is what tight encoding sends for game frames like these, so compress_level is ignored.
+"""
+    def __init__(self, frames, bandwidth, latency):
+        self.frames = frames
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.remotes = {}
+        self._sizes = {}
+
+    def frame_bytes(self, index, quality):
+        import cv2
+        if (index, quality) not in self._sizes:
+            gray = cv2.cvtColor(self.frames[index], cv2.COLOR_RGB2GRAY)
+            self._sizes[index, quality] = len(cv2.imencode('.jpg', gray, [cv2.IMWRITE_JPEG_QUALITY, quality])[1])
+        return self._sizes[index, quality]
+
+    def connect(self, name, address, password, fine_quality_level=50, **_):
+        self.remotes[name] = {'quality': fine_quality_level, 'link_free': time.time(), 'in_flight': [],
+                              'frame': None, 'rendered': None}
+
+    def close(self, name):
+        self.remotes.pop(name, None)
+
+    def step(self, action_d):
+        now = time.time()
+        observation_d, info_d = {}, {}
+        for name, remote in self.remotes.items():
+            if remote['link_free'] <= now:
+                index = int(now * 10) % len(self.frames)
+                size = self.frame_bytes(index, remote['quality'])
+                remote['link_free'] = now + size / float(self.bandwidth)
+                remote['in_flight'].append((remote['link_free'] + self.latency, now, index, size))
+            updates = num_bytes = 0
+            while remote['in_flight'] and remote['in_flight'][0][0] <= now:
+                _, remote['rendered'], remote['frame'], size = remote['in_flight'].pop(0)
+                updates += 1
+                num_bytes += size
+            lag = None if remote['rendered'] is None else now - remote['rendered']
+            observation_d[name] = None if remote['frame'] is None else self.frames[remote['frame']]
+            info_d[name] = {'stats.vnc.updates.n': updates, 'stats.vnc.updates.bytes': num_bytes,
+                            'stats.gauges.diagnostics.lag.observation': [lag, lag]}
+        return observation_d, info_d, {}
+
+
+def vnc_path(args):
+    """
+Steps --batch remotes behind a modelled link of --link-kbps KB/s and --link-latency seconds at --fps
+for --seconds, either with the fixed encoding of create_flash_env or with AdaptiveVNCEncoding, and
+reports the observation lag, the bandwidth and the frames that got through.
+"""
+    from universe import vectorized
+    from envs import AdaptiveVNCEncoding
+
+    class LinkModelEnv(vectorized.Env):
+        """The part of universe's VNCEnv that AdaptiveVNCEncoding relies on, over a LinkModelSession."""
+        def _configure(self, remotes=1, vnc_kwargs=None, **_):
+            self.n = remotes
+            self.vnc_kwargs = vnc_kwargs or {}
+            self.vnc_session = LinkModelSession(flash_frames(16), args.link_kbps * 1024, args.link_latency)
+            self.connection_names = [None] * self.n
+            for i in range(self.n):
+                self.connect(i, str(i), 'localhost:%d' % (5900 + i), 'localhost:%d' % (15900 + i))
+
+        def connect(self, i, name, vnc_address, rewarder_address, vnc_password=None, rewarder_password=None):
+            self.connection_names[i] = name
+            kwargs = dict(self.vnc_kwargs, name=name, address=vnc_address, password=vnc_password)
+            self.vnc_session.connect(**kwargs)
+
+        def _reset(self):
+            return self._step([[]] * self.n)[0]
+
+        def _step(self, action_n):
+            observation_d, info_d, _ = self.vnc_session.step({})
+            return ([observation_d.get(name) for name in self.connection_names], [0.0] * self.n,
+                    [False] * self.n, {'n': [info_d.get(name, {}) for name in self.connection_names]})
+
+    env = LinkModelEnv()
+    if args.path == 'adaptive':
+        env = AdaptiveVNCEncoding(env, interval=int(args.fps * 5))
+    env.configure(remotes=args.batch, vnc_kwargs={'encoding': 'tight', 'compress_level': 0,
+                                                  'fine_quality_level': 50, 'subsample_level': 3})
+    env.reset()
+    lags, num_bytes, updates, levels = [], 0, 0, []
+    start = time.time()
+    while time.time() - start < args.seconds:
+        step_start = time.time()
+        _, _, _, info = env.step([[]] * args.batch)
+        for info_i in info['n']:
+            lag = info_i.get('stats.gauges.diagnostics.lag.observation', [None])[0]
+            if lag is not None:
+                lags.append(lag)
+            num_bytes += info_i.get('stats.vnc.updates.bytes', 0)
+            updates += info_i.get('stats.vnc.updates.n', 0)
+            levels.append(info_i.get('stats.adaptive_encoding.level', 0))
+        time.sleep(max(0.0, 1.0 / args.fps - (time.time() - step_start)))
+    elapsed = time.time() - start
+    return {'path': args.path, 'lag_ms_mean': 1000. * float(np.mean(lags)),
+            'lag_ms_p90': 1000. * float(np.percentile(lags, 90)),
+            'kbytes_per_sec': num_bytes / 1024. / elapsed / args.batch,
+            'updates_per_sec': updates / elapsed / args.batch, 'encoding_level_mean': float(np.mean(levels))}
+
+
+PATHS = {
+    'act': (act_path, ['rnn', 'graph', 'frozen', 'ff']),
+    'flash': (flash_path, ['separate', 'fused']),
+    'atari': (atari_path, ['rgb', 'ale']),
+    'ps': (ps_path, ['adam', 'rmsprop']),
+    'training': (training_path, ['distributed', 'hogwild']),
+    'policy': (policy_path, ['lstm', 'ff']),
+    'vnc': (vnc_path, ['fixed', 'adaptive']),
+}
+
+
+def compare(args):
+    """Runs every path of a benchmark in a subprocess of its own and prints the results side by side."""
+    _, paths = PATHS[args.benchmark]
+    results = []
+    for path in args.paths or paths:
+        cmd = [sys.executable, __file__, '--path', path] + [a for a in sys.argv[1:] if a != '--compare']
+        output = subprocess.check_output(cmd).decode('utf-8')
+        results.append(json.loads(output.strip().split('\n')[-1]))
+
+    keys = sorted(set(k for r in results for k in r if k != 'path'))
+    print('%-24s' % 'path' + ''.join('%14s' % r['path'] for r in results))
+    for k in keys:
+        print('%-24s' % k + ''.join('%14.3f' % r[k] if k in r else '%14s' % '-' for r in results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(PATHS.keys()))
+    parser.add_argument('--compare', action='store_true', help='Run every path of the benchmark')
+    parser.add_argument('--path', default=None, help='Run a single path and print its results as json')
+    parser.add_argument('--paths', default=None, type=lambda s: s.split(','),
+                        help='Comma-separated paths to compare (default: all)')
+    parser.add_argument('--ob-shape', default=[42, 42, 1], type=lambda s: [int(v) for v in s.split(',')],
+                        help='Observation shape, e.g. 42,42,1 for atari or 128,200,1 for flash')
+    parser.add_argument('--num-actions', default=6, type=int)
+    parser.add_argument('--steps', default=1000, type=int, help='Number of timed steps')
+    parser.add_argument('--batch', default=1, type=int, help='Number of observations per step')
+    parser.add_argument('--atari-env-id', default='PongDeterministic-v3', help='Env of the atari benchmark')
+    parser.add_argument('--num-workers', default=4, type=int, help='Number of workers (ps and training benchmarks)')
+    parser.add_argument('--seconds', default=60.0, type=float, help='How long training is measured for (training benchmark)')
+    parser.add_argument('--fps', default=5.0, type=float, help='Steps per second (vnc benchmark)')
+    parser.add_argument('--link-kbps', default=300.0, type=float, help='Bandwidth of the modelled link in KB/s (vnc benchmark)')
+    parser.add_argument('--link-latency', default=0.1, type=float, help='Latency of the modelled link in seconds (vnc benchmark)')
+    parser.add_argument('-o', '--output', default=None, help='Write the compared results to this json file')
+    args = parser.parse_args()
+
+    if args.compare or args.path is None:
+        compare(args)
+    else:
+        fn, _ = PATHS[args.benchmark]
+        print(json.dumps(fn(args)))
+
+
+if __name__ == '__main__':
+    main()
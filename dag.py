@@ -0,0 +1,131 @@
+"""
+A small executor for steps with dependencies.  Steps run on a bounded thread pool as soon as
+everything they depend on has finished, failed steps are retried, and the time each step took
+is recorded.  Used by apc_universe to bring up clusters.
+"""
+from __future__ import print_function
+import logging
+import threading
+import time
+import six.moves.queue as queue
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class StepFailed(Exception):
+    pass
+
+
+class Step(object):
+    """
+A named call of `fn()`.  A return value other than None or 0 (e.g. the exit code of
+a command) counts as a failure, as does an exception.
+"""
+    def __init__(self, name, fn, deps=(), retries=None):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.retries = retries
+
+    def __call__(self):
+        result = self.fn()
+        if result not in (None, 0):
+            raise StepFailed('{} returned {}'.format(self.name, result))
+
+
+class DagExecutor(object):
+    def __init__(self, max_workers=8, retries=2, retry_delay=2.0):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timings = {}
+
+    def _run_step(self, step):
+        retries = self.retries if step.retries is None else step.retries
+        start = time.time()
+        for attempt in range(retries + 1):
+            try:
+                step()
+                self.timings[step.name] = {'seconds': time.time() - start, 'attempts': attempt + 1, 'ok': True}
+                return True
+            except Exception as e:
+                logger.warning('Step %s failed (attempt %d/%d): %s', step.name, attempt + 1, retries + 1, e)
+                if attempt < retries:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        self.timings[step.name] = {'seconds': time.time() - start, 'attempts': retries + 1, 'ok': False}
+        return False
+
+    def run(self, steps):
+        """
+Runs all the steps, and returns the names of those that failed or were skipped
+because something they depend on failed.
+"""
+        steps = dict((step.name, step) for step in steps)
+        for step in steps.values():
+            for dep in step.deps:
+                assert dep in steps, 'Step {} depends on unknown step {}'.format(step.name, dep)
+
+        pending = dict((name, set(step.deps)) for name, step in steps.items())
+        dependents = dict((name, []) for name in steps)
+        for name, step in steps.items():
+            for dep in step.deps:
+                dependents[dep].append(name)
+
+        ready = queue.Queue()
+        done = queue.Queue()
+        failed = set()
+
+        def work():
+            while True:
+                name = ready.get()
+                if name is None:
+                    return
+                done.put((name, self._run_step(steps[name])))
+
+        threads = [threading.Thread(target=work) for _ in range(min(self.max_workers, max(1, len(steps))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for name in [name for name, deps in pending.items() if not deps]:
+            del pending[name]
+            ready.put(name)
+        running = len(steps) - len(pending)
+
+        def skip(name):
+            # everything downstream of a failed step is skipped
+            for dependent in dependents[name]:
+                if dependent in pending:
+                    del pending[dependent]
+                    failed.add(dependent)
+                    self.timings[dependent] = {'seconds': 0.0, 'attempts': 0, 'ok': False}
+                    skip(dependent)
+
+        start = time.time()
+        while running > 0:
+            name, ok = done.get()
+            running -= 1
+            if not ok:
+                failed.add(name)
+                skip(name)
+                continue
+            for dependent in dependents[name]:
+                if dependent in pending:
+                    pending[dependent].discard(name)
+                    if not pending[dependent]:
+                        del pending[dependent]
+                        ready.put(dependent)
+                        running += 1
+
+        for _ in threads:
+            ready.put(None)
+        self.total_seconds = time.time() - start
+        return failed
+
+    def report(self):
+        print('{:<40} {:>9} {:>9}'.format('step', 'seconds', 'attempts'))
+        for name, timing in sorted(self.timings.items(), key=lambda t: -t[1]['seconds']):
+            print('{:<40} {:>9.2f} {:>9}{}'.format(name, timing['seconds'], timing['attempts'],
+                                                   '' if timing['ok'] else '  FAILED'))
+        print('{:<40} {:>9.2f}'.format('total', self.total_seconds))
@@ -6,10 +6,13 @@ from gym import spaces
 import logging
 import universe
 from universe import vectorized
-from universe.wrappers import BlockingReset, GymCoreAction, EpisodeID, Unvectorize, Vectorize, Vision, Logger
+from universe.wrappers import BlockingReset, GymCoreAction, EpisodeID, Unvectorize, Vectorize, Vision, Logger, Throttle
 from universe import spaces as vnc_spaces
 from universe.spaces.vnc_event import keycode
 import time
+import zlib
+from collections import namedtuple
+from trajectory import ReplayEnv
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -29,29 +32,39 @@ def config_universe_logging(enable_logfile=False, path=None):
         universe.configure_logging(False)
 
 
-def create_env(env_id, client_id, remotes, **kwargs):
-    spec = gym.spec(env_id)
-
-    if spec.tags.get('flashgames', False):
-        return create_flash_env(env_id, client_id, remotes, **kwargs)
-    elif spec.tags.get('atari', False) and spec.tags.get('vnc', False):
-        return create_vncatari_env(env_id, client_id, remotes, **kwargs)
+def create_env(env_id, client_id, remotes, frame_stack=1, **kwargs):
+    if env_id.startswith('replay:'):
+        # the recorded observations are already stacked
+        return create_replay_env(env_id[len('replay:'):], client_id)
+    if env_id.startswith('synthetic'):
+        env = create_synthetic_env(env_id)
     else:
-        # Assume atari.
-        assert "." not in env_id  # universe environments have dots in names.
-        return create_atari_env(env_id)
+        spec = gym.spec(env_id)
+        if spec.tags.get('flashgames', False):
+            env = create_flash_env(env_id, client_id, remotes, **kwargs)
+        elif spec.tags.get('atari', False) and spec.tags.get('vnc', False):
+            env = create_vncatari_env(env_id, client_id, remotes, **kwargs)
+        else:
+            # Assume atari.
+            assert "." not in env_id  # universe environments have dots in names.
+            env = create_atari_env(env_id, **kwargs)
+    if frame_stack > 1:
+        env = FrameStack(env, frame_stack)
+    return env
 
-def create_flash_env(env_id, client_id, remotes, **_):
+def create_flash_env(env_id, client_id, remotes, adaptive_fps=None, adaptive_encoding=False,
+                     max_vnc_bytes_per_sec=None, **_):
     env = gym.make(env_id)
     env = Vision(env)
     env = Logger(env)
     env = BlockingReset(env)
+    if adaptive_encoding:
+        env = AdaptiveVNCEncoding(env, max_bytes_per_sec=max_vnc_bytes_per_sec)
 
     reg = universe.runtime_spec('flashgames').server_registry
     height = reg[env_id]["height"]
     width = reg[env_id]["width"]
-    env = CropScreen(env, height, width, 84, 18)
-    env = FlashRescale(env)
+    env = ObservationCache(FlashCropRescale(env, height, width, 84, 18))
 
     keys = ['left', 'right', 'up', 'down', 'x']
     if env_id == 'flashgames.NeonRace-v0':
@@ -61,6 +74,8 @@ def create_flash_env(env_id, client_id, remotes, **_):
 
     env = DiscreteToFixedKeysVNCActions(env, keys)
     env = EpisodeID(env)
+    if adaptive_fps is not None:
+        env = AdaptiveFps(env, *adaptive_fps)
     env = DiagnosticsInfo(env)
     env = Unvectorize(env)
     env.configure(fps=5.0, remotes=remotes, start_timeout=15 * 60, client_id=client_id,
@@ -69,14 +84,16 @@ def create_flash_env(env_id, client_id, remotes, **_):
                     'fine_quality_level': 50, 'subsample_level': 3})
     return env
 
-def create_vncatari_env(env_id, client_id, remotes, **_):
+def create_vncatari_env(env_id, client_id, remotes, adaptive_fps=None, **_):
     env = gym.make(env_id)
     env = Vision(env)
     env = Logger(env)
     env = BlockingReset(env)
     env = GymCoreAction(env)
-    env = AtariRescale42x42(env)
+    env = ObservationCache(AtariRescale42x42(env))
     env = EpisodeID(env)
+    if adaptive_fps is not None:
+        env = AdaptiveFps(env, *adaptive_fps)
     env = DiagnosticsInfo(env)
     env = Unvectorize(env)
 
@@ -85,14 +102,64 @@ def create_vncatari_env(env_id, client_id, remotes, **_):
     env.configure(remotes=remotes, start_timeout=15 * 60, fps=fps, client_id=client_id)
     return env
 
-def create_atari_env(env_id):
+def create_atari_env(env_id, atari_backend='rgb', **_):
     env = gym.make(env_id)
+    if atari_backend == 'ale':
+        env = AtariScreen42x42(env)
+        env = Vectorize(env)
+    else:
+        env = Vectorize(env)
+        env = AtariRescale42x42(env)
+    env = DiagnosticsInfo(env)
+    env = Unvectorize(env)
+    return env
+
+def create_replay_env(path, client_id):
+    env = ReplayEnv(path, client_id)
     env = Vectorize(env)
-    env = AtariRescale42x42(env)
     env = DiagnosticsInfo(env)
     env = Unvectorize(env)
     return env
 
+def create_synthetic_env(env_id):
+    if env_id == 'synthetic.flash':
+        env = SyntheticEnv([128, 200, 1], 8)
+    else:
+        env = SyntheticEnv([42, 42, 1], 6)
+    env = Vectorize(env)
+    env = DiagnosticsInfo(env)
+    env = Unvectorize(env)
+    return env
+
+SyntheticSpec = namedtuple('SyntheticSpec', ['id', 'tags'])
+
+class SyntheticEnv(gym.Env):
+    """
+Returns random observations of the shape of the preprocessed atari (or flash, with env id
+synthetic.flash) observations as fast as it is stepped, so that the agent can be benchmarked
+without paying for an environment.
+"""
+    metadata = {}
+
+    def __init__(self, ob_shape, num_actions, episode_length=1000, seed=0):
+        rng = np.random.RandomState(seed)
+        self._obs = rng.rand(*([16] + list(ob_shape))).astype(np.float32)
+        self._rewards = rng.choice([-1.0, 0.0, 0.0, 0.0, 1.0], size=episode_length)
+        self._episode_length = episode_length
+        self._t = 0
+        self.observation_space = Box(0.0, 1.0, ob_shape)
+        self.action_space = spaces.Discrete(num_actions)
+        self.spec = SyntheticSpec('synthetic', {'wrapper_config.TimeLimit.max_episode_steps': episode_length})
+
+    def _reset(self):
+        self._t = 0
+        return self._obs[0]
+
+    def _step(self, action):
+        reward = self._rewards[self._t]
+        self._t += 1
+        return self._obs[self._t % len(self._obs)], reward, self._t >= self._episode_length, {}
+
 def DiagnosticsInfo(env, *args, **kwargs):
     return vectorized.VectorizeFilter(env, DiagnosticsInfoI, *args, **kwargs)
 
@@ -108,6 +175,8 @@ class DiagnosticsInfoI(vectorized.Filter):
         self._episode_length = 0
         self._all_rewards = []
         self._num_vnc_updates = 0
+        self._num_cache_hits = 0
+        self._num_vnc_bytes = 0
         self._last_episode_id = -1
 
     def _after_reset(self, observation):
@@ -125,6 +194,10 @@ class DiagnosticsInfoI(vectorized.Filter):
         self._local_t += 1
         if info.get("stats.vnc.updates.n") is not None:
             self._num_vnc_updates += info.get("stats.vnc.updates.n")
+        if info.get("stats.observation_cache.hit") is not None:
+            self._num_cache_hits += info["stats.observation_cache.hit"]
+        if info.get("stats.vnc.updates.bytes") is not None:
+            self._num_vnc_bytes += info["stats.vnc.updates.bytes"]
 
         if self._local_t % self._log_interval == 0:
             cur_time = time.time()
@@ -152,8 +225,17 @@ class DiagnosticsInfoI(vectorized.Filter):
                 to_log["diagnostics/vnc_updates_n"] = info["stats.vnc.updates.n"]
                 to_log["diagnostics/vnc_updates_n_ps"] = self._num_vnc_updates / elapsed
                 self._num_vnc_updates = 0
+            if info.get("stats.adaptive_fps.target") is not None:
+                to_log["diagnostics/target_fps"] = info["stats.adaptive_fps.target"]
+            if info.get("stats.observation_cache.hit") is not None:
+                to_log["diagnostics/observation_cache_hit_rate"] = self._num_cache_hits / float(self._log_interval)
+                self._num_cache_hits = 0
             if info.get("stats.vnc.updates.bytes") is not None:
                 to_log["diagnostics/vnc_updates_bytes"] = info["stats.vnc.updates.bytes"]
+                to_log["diagnostics/vnc_updates_bytes_ps"] = self._num_vnc_bytes / elapsed
+                self._num_vnc_bytes = 0
+            if info.get("stats.adaptive_encoding.level") is not None:
+                to_log["diagnostics/vnc_encoding_level"] = info["stats.adaptive_encoding.level"]
             if info.get("stats.vnc.updates.pixels") is not None:
                 to_log["diagnostics/vnc_updates_pixels"] = info["stats.vnc.updates.pixels"]
             if info.get("stats.vnc.updates.rectangles") is not None:
@@ -201,6 +283,305 @@ class AtariRescale42x42(vectorized.ObservationWrapper):
     def _observation(self, observation_n):
         return [_process_frame42(observation) for observation in observation_n]
 
+class ObservationCache(vectorized.Wrapper):
+    """
+Wraps a preprocessing ObservationWrapper, and only runs its preprocessing on frames that changed.
+When the VNC driver reports no updates for an env, or the crc32 of its raw frame matches the last
+processed one, the last preprocessed observation is returned again.  Whether each step was a hit
+is reported in the info as stats.observation_cache.hit, for DiagnosticsInfo.
+"""
+    def __init__(self, env):
+        super(ObservationCache, self).__init__(env)
+        self._process = env._observation
+        self._observations = []
+        self._hashes = []
+
+    def _frame_hash(self, frame):
+        return zlib.crc32(np.ascontiguousarray(frame)) if frame is not None else None
+
+    def _reset(self):
+        # the raw frames come from the env under the preprocessing wrapper
+        observation_n = self.env.env.reset()
+        self._observations = self._process(observation_n)
+        self._hashes = [self._frame_hash(frame) for frame in observation_n]
+        return list(self._observations)
+
+    def _step(self, action_n):
+        observation_n, reward_n, done_n, info = self.env.env.step(action_n)
+        for i, frame in enumerate(observation_n):
+            updates = info['n'][i].get('stats.vnc.updates.n')
+            hit = False
+            if frame is not None and self._hashes[i] is not None:
+                if updates == 0:
+                    hit = True
+                else:
+                    frame_hash = self._frame_hash(frame)
+                    hit = frame_hash == self._hashes[i]
+                    self._hashes[i] = frame_hash
+            else:
+                self._hashes[i] = self._frame_hash(frame)
+            if not hit:
+                self._observations[i] = self._process([frame])[0]
+            info['n'][i]['stats.observation_cache.hit'] = int(hit)
+        return list(self._observations), reward_n, done_n, info
+
+class AdaptiveFps(vectorized.Wrapper):
+    """
+Adjusts the fps universe throttles the env to, within [min_fps, max_fps].  Every `interval` steps,
+the fps is lowered when the upper bound of the action or observation lag exceeds `max_lag` seconds,
+and raised when the lag is below half of that and the throttle still sleeps for more than `headroom`
+of every frame, i.e. when the actor keeps up with time to spare.  Decisions are logged, and the
+current fps is reported in the info as stats.adaptive_fps.target, for DiagnosticsInfo.
+"""
+    def __init__(self, env, min_fps, max_fps, max_lag=0.2, headroom=0.3, interval=50, step_up=1.25, step_down=0.8):
+        super(AdaptiveFps, self).__init__(env)
+        self.min_fps = min_fps
+        self.max_fps = max_fps
+        self.max_lag = max_lag
+        self.headroom = headroom
+        self.interval = interval
+        self.step_up = step_up
+        self.step_down = step_down
+        self._throttle = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._steps = 0
+        self._sleep = 0.0
+        self._lags = []
+
+    def _find_throttle(self):
+        env = self.env
+        while env is not None and not isinstance(env, Throttle):
+            env = getattr(env, 'env', None)
+        if env is None:
+            logger.warn('AdaptiveFps: no Throttle wrapper found, the fps will not be adjusted')
+        return env
+
+    def _set_fps(self, fps):
+        self._throttle.fps = fps
+        # the throttle schedules frames from the time its timer started
+        self._throttle._start_timer()
+
+    def _step(self, action_n):
+        if self._throttle is None:
+            self._throttle = self._find_throttle() or False
+            if self._throttle and self._throttle.fps is not None:
+                self._set_fps(min(self.max_fps, max(self.min_fps, self._throttle.fps)))
+        observation_n, reward_n, done_n, info = self.env.step(action_n)
+        if not self._throttle or self._throttle.fps is None:
+            return observation_n, reward_n, done_n, info
+
+        self._steps += 1
+        self._sleep += info.get('stats.throttle.sleep', 0.0)
+        for info_i in info['n']:
+            for gauge in ('stats.gauges.diagnostics.lag.action', 'stats.gauges.diagnostics.lag.observation'):
+                if info_i.get(gauge) is not None and info_i[gauge][1] is not None:
+                    self._lags.append(info_i[gauge][1])
+
+        if self._steps >= self.interval:
+            fps = self._throttle.fps
+            lag = np.mean(self._lags) if self._lags else None
+            sleep_fraction = self._sleep / self._steps * fps
+            if lag is not None and lag > self.max_lag:
+                new_fps, reason = max(self.min_fps, fps * self.step_down), 'lag is too high'
+            elif (lag is None or lag < self.max_lag / 2) and sleep_fraction > self.headroom:
+                new_fps, reason = min(self.max_fps, fps * self.step_up), 'actor has headroom'
+            else:
+                new_fps, reason = fps, None
+            if new_fps != fps:
+                logger.info('AdaptiveFps: %.2f -> %.2f fps, %s (mean lag %s, throttle sleeps %.0f%% of each frame)',
+                            fps, new_fps, reason, 'n/a' if lag is None else '%.3fs' % lag, 100 * sleep_fraction)
+                self._set_fps(new_fps)
+            self._reset_stats()
+
+        for info_i in info['n']:
+            info_i['stats.adaptive_fps.target'] = self._throttle.fps
+        return observation_n, reward_n, done_n, info
+
+# Tight encoding settings of AdaptiveVNCEncoding, from the least to the most compressed.  Level 0 is
+# what create_flash_env has always used; subsample_level 3 (grayscale) is kept, since we average the
+# channels anyway.
+VNC_ENCODING_LEVELS = [
+    {'compress_level': 0, 'fine_quality_level': 50},
+    {'compress_level': 3, 'fine_quality_level': 40},
+    {'compress_level': 6, 'fine_quality_level': 30},
+    {'compress_level': 9, 'fine_quality_level': 20},
+    {'compress_level': 9, 'fine_quality_level': 10},
+]
+
+class AdaptiveVNCEncoding(vectorized.Wrapper):
+    """
+Tunes the compression and JPEG quality of the VNC connection of every remote on its own, stepping
+through VNC_ENCODING_LEVELS.  Every `interval` steps, a remote moves to the next, more compressed level
+when the upper bound of its observation lag exceeds `max_lag` seconds, or when it received more than
+`max_bytes_per_sec` (if given).  It moves back one level after `patience` intervals in a row with less
+than half that lag and, with a budget, less than half the budget.
+
+The VNC driver takes its encoding settings when it connects, so a remote is re-tuned by closing and
+reopening its VNC connection (the rewarder connection is kept).  Until the first frame of the new
+connection arrives, the last frame of the remote is returned again.  The wrapper has to sit below
+the preprocessing wrappers, and be configured before the env connects, which env.configure takes care of.
+The level of every remote is reported in the info as stats.adaptive_encoding.level, for DiagnosticsInfo.
+"""
+    def __init__(self, env, max_lag=0.2, max_bytes_per_sec=None, interval=50, patience=3):
+        super(AdaptiveVNCEncoding, self).__init__(env)
+        self.max_lag = max_lag
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.interval = interval
+        self.patience = patience
+        self._vnc = None
+        self._remotes = {}
+        self._levels = {}
+        self._calm = {}
+        self._frames = {}
+        self._reconnecting = set()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._steps = 0
+        self._start = time.time()
+        self._bytes = {}
+        self._lags = {}
+
+    def _configure(self, **kwargs):
+        self._vnc = vnc = self.env.unwrapped
+        vnc_kwargs = dict(kwargs.get('vnc_kwargs') or {})
+        vnc_kwargs.update(VNC_ENCODING_LEVELS[0])
+        kwargs['vnc_kwargs'] = vnc_kwargs
+        connect = vnc.connect
+
+        # remember the address of every connection, which the VNC env only logs
+        def recording_connect(i, name, vnc_address, rewarder_address, vnc_password=None, rewarder_password=None):
+            self._remotes[i] = (name, vnc_address, vnc_password)
+            self._levels[i] = 0
+            self._calm[i] = 0
+            self._reconnecting.discard(i)
+            return connect(i, name, vnc_address, rewarder_address,
+                           vnc_password=vnc_password, rewarder_password=rewarder_password)
+        vnc.connect = recording_connect
+        super(AdaptiveVNCEncoding, self)._configure(**kwargs)
+
+    def _set_level(self, i, level, reason, bytes_per_sec, lag):
+        name, address, password = self._remotes[i]
+        logger.info('AdaptiveVNCEncoding: %s level %d -> %d (%s), %s, %.0f KB/s, mean observation lag %s',
+                    name, self._levels[i], level, VNC_ENCODING_LEVELS[level], reason, bytes_per_sec / 1024.,
+                    'n/a' if lag is None else '%.3fs' % lag)
+        kwargs = dict(self._vnc.vnc_kwargs)
+        kwargs.update(VNC_ENCODING_LEVELS[level])
+        kwargs.update(name=name, address=address, password=password)
+        self._vnc.vnc_session.close(name)
+        self._vnc.vnc_session.connect(**kwargs)
+        self._levels[i] = level
+        self._calm[i] = 0
+        self._reconnecting.add(i)
+
+    def _retune(self, elapsed):
+        for i in self._remotes:
+            bytes_per_sec = self._bytes.get(i, 0) / elapsed
+            lags = self._lags.get(i)
+            lag = np.mean(lags) if lags else None
+            level = self._levels[i]
+            over_budget = self.max_bytes_per_sec is not None and bytes_per_sec > self.max_bytes_per_sec
+            if (lag is not None and lag > self.max_lag) or over_budget:
+                if level + 1 < len(VNC_ENCODING_LEVELS):
+                    reason = 'over the bandwidth budget' if over_budget else 'lag is too high'
+                    self._set_level(i, level + 1, reason, bytes_per_sec, lag)
+                continue
+            calm = (lag is None or lag < self.max_lag / 2) and \
+                (self.max_bytes_per_sec is None or bytes_per_sec < self.max_bytes_per_sec / 2)
+            self._calm[i] = self._calm[i] + 1 if calm else 0
+            if level > 0 and self._calm[i] >= self.patience:
+                self._set_level(i, level - 1, 'link has room', bytes_per_sec, lag)
+
+    def _reset(self):
+        observation_n = self.env.reset()
+        self._frames = dict(enumerate(observation_n))
+        return observation_n
+
+    def _step(self, action_n):
+        observation_n, reward_n, done_n, info = self.env.step(action_n)
+        for i, info_i in enumerate(info['n']):
+            if observation_n[i] is None and i in self._reconnecting:
+                observation_n[i] = self._frames.get(i)
+            elif observation_n[i] is not None:
+                self._reconnecting.discard(i)
+                self._frames[i] = observation_n[i]
+            if info_i.get('stats.vnc.updates.bytes') is not None:
+                self._bytes[i] = self._bytes.get(i, 0) + info_i['stats.vnc.updates.bytes']
+            lag = info_i.get('stats.gauges.diagnostics.lag.observation')
+            if lag is not None and lag[1] is not None:
+                self._lags.setdefault(i, []).append(lag[1])
+            if i in self._levels:
+                info_i['stats.adaptive_encoding.level'] = self._levels[i]
+
+        self._steps += 1
+        if self._steps >= self.interval:
+            self._retune(time.time() - self._start)
+            self._reset_stats()
+        return observation_n, reward_n, done_n, info
+
+class AtariScreen42x42(gym.Wrapper):
+    """
+Steps the emulator directly and reads its RGB screen into a reusable buffer, skipping the
+rendering and the copy of the screen by gym's atari env.  The observation is computed from that
+buffer by _process_frame42, so it is the same as that of AtariRescale42x42, and policies trained
+with either backend run on the other.
+"""
+    def __init__(self, env):
+        super(AtariScreen42x42, self).__init__(env)
+        self.observation_space = Box(0.0, 1.0, [42, 42, 1])
+        self._ale = env.unwrapped.ale
+        width, height = self._ale.getScreenDims()
+        self._screen = np.empty((height, width, 3), np.uint8)
+
+    def _screen_observation(self):
+        self._ale.getScreenRGB(self._screen)
+        return _process_frame42(self._screen)
+
+    def _reset(self):
+        self.env.reset()
+        return self._screen_observation()
+
+    def _step(self, action):
+        # the same frame skipping as gym's AtariEnv._step, without rendering the screen
+        atari = self.env.unwrapped
+        ale_action = atari._action_set[action]
+        if isinstance(atari.frameskip, int):
+            num_steps = atari.frameskip
+        else:
+            num_steps = atari.np_random.randint(atari.frameskip[0], atari.frameskip[1])
+        reward = 0.0
+        for _ in range(num_steps):
+            reward += self._ale.act(ale_action)
+        return self._screen_observation(), reward, self._ale.game_over(), {"ale.lives": self._ale.lives()}
+
+class FrameStack(gym.Wrapper):
+    """
+Stacks the last k observations of the env along their channels, for policies without recurrent
+state (model.FFPolicy).  At the start of an episode, its first observation fills the whole stack.
+"""
+    def __init__(self, env, k):
+        super(FrameStack, self).__init__(env)
+        self.k = k
+        shape = list(env.observation_space.shape)
+        self.observation_space = Box(0.0, 1.0, shape[:-1] + [shape[-1] * k])
+        self._frames = []
+
+    def _reset(self):
+        observation = self.env.reset()
+        self._frames = [observation] * self.k
+        return np.concatenate(self._frames, axis=-1)
+
+    def _step(self, action):
+        observation, reward, done, info = self.env.step(action)
+        if done:
+            # universe envs reset themselves, and already return the first observation of the next episode
+            self._frames = [observation] * self.k
+        else:
+            self._frames = self._frames[1:] + [observation]
+        return np.concatenate(self._frames, axis=-1), reward, done, info
+
 class FixedKeyState(object):
     def __init__(self, keys):
         self._keys = [keycode(key) for key in keys]
@@ -234,6 +615,9 @@ class DiscreteToFixedKeysVNCActions(vectorized.ActionWrapper):
     You can define a state with more than one key down by separating with spaces. For example,
        e=DiscreteToFixedKeysVNCActions(e, ['left', 'right', 'space', 'left space', 'right space'])
     will have 6 actions: [none, left, right, space, left space, right space]
+
+    Only the keys that change since the previous action of an env are sent; the full state of
+    every key is sent after a reset, or after an episode of that env ended.
     """
     def __init__(self, env, keys):
         super(DiscreteToFixedKeysVNCActions, self).__init__(env)
@@ -241,6 +625,8 @@ class DiscreteToFixedKeysVNCActions(vectorized.ActionWrapper):
         self._keys = keys
         self._generate_actions()
         self.action_space = spaces.Discrete(len(self._actions))
+        # the action each env is in, or None when its key state is unknown (and the full action must be sent)
+        self._current = []
 
     def _generate_actions(self):
         self._actions = []
@@ -249,18 +635,46 @@ class DiscreteToFixedKeysVNCActions(vectorized.ActionWrapper):
             for cur_key in key.split(' '):
                 uniq_keys.add(cur_key)
 
+        down_keys = []
         for key in [''] + self._keys:
             split_keys = key.split(' ')
             cur_action = []
             for cur_key in uniq_keys:
                 cur_action.append(vnc_spaces.KeyEvent.by_name(cur_key, down=(cur_key in split_keys)))
             self._actions.append(cur_action)
+            down_keys.append(set(split_keys) & uniq_keys)
         self.key_state = FixedKeyState(uniq_keys)
 
+        # _transitions[a][b] only has the events of the keys that change going from action a to action b
+        self._transitions = [[[vnc_spaces.KeyEvent.by_name(cur_key, down=(cur_key in to_keys))
+                               for cur_key in uniq_keys if (cur_key in from_keys) != (cur_key in to_keys)]
+                              for to_keys in down_keys]
+                             for from_keys in down_keys]
+
+    def _reset(self):
+        self._current = []
+        return self.env.reset()
+
+    def _step(self, action_n):
+        observation_n, reward_n, done_n, info = self.env.step(self._action(action_n))
+        for i, done in enumerate(done_n):
+            if done:
+                # the keys of a reset env may have been released
+                self._current[i] = None
+        return observation_n, reward_n, done_n, info
+
     def _action(self, action_n):
         # Each action might be a length-1 np.array. Cast to int to
         # avoid warnings.
-        return [self._actions[int(action)] for action in action_n]
+        if len(self._current) != len(action_n):
+            self._current = [None] * len(action_n)
+        events_n = []
+        for i, action in enumerate(action_n):
+            action = int(action)
+            current = self._current[i]
+            events_n.append(self._actions[action] if current is None else self._transitions[current][action])
+            self._current[i] = action
+        return events_n
 
 class CropScreen(vectorized.ObservationWrapper):
     """Crops out a [height]x[width] area starting from (top,left) """
@@ -290,3 +704,38 @@ class FlashRescale(vectorized.ObservationWrapper):
 
     def _observation(self, observation_n):
         return [_process_frame_flash(observation) for observation in observation_n]
+
+
+# The largest difference between the outputs of FlashCropRescale and of CropScreen followed by
+# FlashRescale: the separate path rounds the resized channels to uint8 before averaging them, which
+# is off by at most half a gray level, and cv2 resizes uint8 images with fixed-point weights.
+FLASH_FUSED_TOLERANCE = 1.0 / 255.0
+
+def _process_frame_flash_fused(frame, top, left, gray):
+    height, width = gray.shape
+    crop = frame[top:top+height, left:left+width, :]
+    np.sum(crop, axis=2, dtype=np.float32, out=gray)
+    out = np.empty((128, 200), np.float32)
+    # the same bilinear interpolation as FlashRescale, which is linear, so it commutes with the channel sum
+    cv2.resize(gray, (200, 128), dst=out, interpolation=cv2.INTER_LINEAR)
+    out *= (1.0 / (3 * 255.0))
+    return out.reshape([128, 200, 1])
+
+class FlashCropRescale(vectorized.ObservationWrapper):
+    """
+Fused equivalent of CropScreen followed by FlashRescale, within FLASH_FUSED_TOLERANCE.  The
+channels of the crop are summed straight into a preallocated float32 buffer (averaging and
+resizing commute, so we only resize a third of the data) which is then resized into the output
+array and scaled in place.  Only the output array is allocated per frame, since rollouts keep
+references to observations.
+"""
+    def __init__(self, env, height, width, top=0, left=0):
+        super(FlashCropRescale, self).__init__(env)
+        self.top = top
+        self.left = left
+        self.observation_space = Box(0.0, 1.0, [128, 200, 1])
+        self._gray = np.empty((height, width), np.float32)
+
+    def _observation(self, observation_n):
+        return [_process_frame_flash_fused(ob, self.top, self.left, self._gray) if ob is not None else None
+                for ob in observation_n]
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+Evaluates a checkpoint of the policy without a ps or any other part of the training cluster.
+Every env runs in a process of its own, and the policy acts for all of them in one batched
+sess.run per step.  Per-episode results and throughput go to a json file.
+
+    python evaluate.py --log-dir /tmp/pong --env-id PongDeterministic-v3 --num-envs 8 --episodes 32
+"""
+from __future__ import print_function
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def run_env(conn, env_id, client_id, remotes, frame_stack=1):
+    """
+The loop of an env process: steps the env with the actions it receives, and resets it at the
+end of every episode like env_runner does.  Sends back (observation, reward, episode_done).
+"""
+    from envs import create_env
+    env = create_env(env_id, client_id=client_id, remotes=remotes, frame_stack=frame_stack)
+    timestep_limit = env.spec.tags.get('wrapper_config.TimeLimit.max_episode_steps')
+    autoreset = env.metadata.get('semantics.autoreset')
+    conn.send((list(env.observation_space.shape), env.action_space.n))
+    conn.send(env.reset())
+    length = 0
+    while True:
+        action = conn.recv()
+        if action is None:
+            break
+        ob, reward, terminal, _ = env.step(action)
+        length += 1
+        done = terminal or (timestep_limit is not None and length >= timestep_limit)
+        if done:
+            if not terminal or not autoreset:
+                ob = env.reset()
+            length = 0
+        conn.send((ob, reward, done))
+    env.close()
+
+
+class EnvProcess(object):
+    def __init__(self, env_id, client_id, remotes, frame_stack=1):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=run_env,
+                                               args=(child_conn, env_id, client_id, remotes, frame_stack))
+        self.process.daemon = True
+        self.process.start()
+
+    def close(self):
+        self.conn.send(None)
+        self.process.join(10)
+
+
+def evaluate(args):
+    remotes = args.remotes.split(',') if args.remotes else ['1'] * args.num_envs
+    assert len(remotes) == args.num_envs, 'give one remote per env'
+    config = None
+    if args.policy_config:
+        with open(args.policy_config) as f:
+            config = json.load(f)['config']
+    # the env processes are forked before tensorflow starts any threads
+    frame_stack = config.get('frames', 1) if config else 1
+    envs = [EnvProcess(args.env_id, str(i), remotes[i], frame_stack) for i in range(args.num_envs)]
+    ob_shape, num_actions = envs[0].conn.recv()
+    for env in envs[1:]:
+        env.conn.recv()
+
+    import tensorflow as tf
+    from model import create_policy, PolicyConfig
+
+    with tf.variable_scope("global"):
+        policy = create_policy(ob_shape, num_actions, PolicyConfig(**config) if config else None)
+    policy.build_batch_step()
+
+    checkpoint = args.checkpoint or tf.train.latest_checkpoint(os.path.join(args.log_dir, 'vehicle'))
+    if checkpoint is None:
+        raise ValueError('No checkpoint found in {}'.format(os.path.join(args.log_dir, 'vehicle')))
+    sess = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=args.intra_op_threads,
+                                            inter_op_parallelism_threads=2))
+    tf.train.Saver(policy.var_list).restore(sess, checkpoint)
+    logger.info('Restored %s', checkpoint)
+
+    episodes_per_env = int(math.ceil(float(args.episodes) / args.num_envs))
+    obs = [env.conn.recv() for env in envs]
+    # the state of every env, for the policies that have one
+    state_init = policy.get_initial_features()
+    states = [np.repeat(s, args.num_envs, 0) for s in state_init]
+    episode_reward = [0.0] * args.num_envs
+    episode_length = [0] * args.num_envs
+    episode_start = [time.time()] * args.num_envs
+    num_episodes = [0] * args.num_envs
+    episodes = []
+    active = list(range(args.num_envs))
+    num_steps, num_batches, act_seconds = 0, 0, 0.0
+
+    start = time.time()
+    while active:
+        act_start = time.time()
+        feed = {policy.batch_x: [obs[i] for i in active]}
+        feed.update(zip(policy.batch_state_in, [s[active] for s in states]))
+        fetched = sess.run([policy.batch_logits, policy.batch_sample] + policy.batch_state_out, feed)
+        act_seconds += time.time() - act_start
+        num_batches += 1
+        logits, sample = fetched[:2]
+        actions = logits.argmax(1) if args.greedy else sample
+        for s, s_out in zip(states, fetched[2:]):
+            s[active] = s_out
+
+        for i, action in zip(active, actions):
+            envs[i].conn.send(int(action))
+        for i in list(active):
+            obs[i], reward, done = envs[i].conn.recv()
+            episode_reward[i] += reward
+            episode_length[i] += 1
+            num_steps += 1
+            if done:
+                episodes.append({'env': i, 'reward': episode_reward[i], 'length': episode_length[i],
+                                 'seconds': time.time() - episode_start[i]})
+                logger.info('env %d: episode reward %.1f, length %d', i, episode_reward[i], episode_length[i])
+                num_episodes[i] += 1
+                episode_reward[i], episode_length[i], episode_start[i] = 0.0, 0, time.time()
+                for s, s_init in zip(states, state_init):
+                    s[i] = s_init[0]
+                if num_episodes[i] >= episodes_per_env:
+                    active.remove(i)
+    elapsed = time.time() - start
+
+    for env in envs:
+        env.close()
+    rewards = [e['reward'] for e in episodes]
+    return {'checkpoint': checkpoint, 'env_id': args.env_id, 'greedy': args.greedy, 'num_envs': args.num_envs,
+            'episodes': episodes, 'mean_reward': float(np.mean(rewards)), 'std_reward': float(np.std(rewards)),
+            'steps': num_steps, 'seconds': elapsed, 'steps_per_sec': num_steps / elapsed,
+            'act_ms_per_batch': 1000 * act_seconds / num_batches}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a checkpoint of the policy")
+    parser.add_argument('-l', '--log-dir', default="/tmp/pong",
+                        help='Log directory of the training session whose latest checkpoint is evaluated')
+    parser.add_argument('--checkpoint', default=None, help='Evaluate this checkpoint instead of the latest one')
+    parser.add_argument('-e', '--env-id', default="PongDeterministic-v3", help='Environment id')
+    parser.add_argument('-r', '--remotes', default=None,
+                        help='One remote per env, as for worker.py (e.g. -r vnc://localhost:5900+15900,...). '
+                             'By default every env starts a local one.')
+    parser.add_argument('-n', '--num-envs', default=4, type=int, help='Number of env processes')
+    parser.add_argument('--episodes', default=20, type=int,
+                        help='Number of episodes to run, split evenly between the envs')
+    parser.add_argument('--greedy', default=False, action='store_true',
+                        help='Take the most likely action instead of sampling from the policy')
+    parser.add_argument('--policy-config', default=None,
+                        help='model_profile.json of the session, for policies trained with a non-default '
+                             'architecture (default: <log-dir>/model_profile.json if it exists)')
+    parser.add_argument('--intra-op-threads', default=1, type=int, help='Size of the TF intra-op thread pool')
+    parser.add_argument('-o', '--output', default=None, help='Results json (default: <log-dir>/eval.json)')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    if args.policy_config is None and os.path.exists(os.path.join(args.log_dir, 'model_profile.json')):
+        args.policy_config = os.path.join(args.log_dir, 'model_profile.json')
+
+    result = evaluate(args)
+    output = args.output or os.path.join(args.log_dir, 'eval.json')
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('{} episodes: mean reward {:.2f} (std {:.2f}), {:.1f} steps/sec. Results in {}'.format(
+        len(result['episodes']), result['mean_reward'], result['std_reward'], result['steps_per_sec'], output))
+
+
+if __name__ == '__main__':
+    main()
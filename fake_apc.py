@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the apc command line, for exercising apc_universe without a cluster:
+
+    python apc_universe.py --apc ./fake_apc.py deploy 8
+
+It understands the subset of apc that ApceraApi uses, keeps its state in the json file
+named by $FAKE_APC_STATE (default /tmp/fake_apc.json), sleeps $FAKE_APC_LATENCY seconds
+(default 0.2) per call like a remote control plane would, and fails a random
+$FAKE_APC_FAILURE_RATE fraction (default 0) of the mutating calls.
+"""
+from __future__ import print_function
+import fcntl
+import json
+import os
+import random
+import sys
+import time
+
+STATE = os.environ.get('FAKE_APC_STATE', '/tmp/fake_apc.json')
+LATENCY = float(os.environ.get('FAKE_APC_LATENCY', '0.2'))
+FAILURE_RATE = float(os.environ.get('FAKE_APC_FAILURE_RATE', '0'))
+
+
+def html_table(headers, rows):
+    out = '<table><tr>' + ''.join('<th>{}</th>'.format(h) for h in headers) + '</tr>'
+    for row in rows:
+        out += '<tr>' + ''.join('<td>{}</td>'.format(v) for v in row) + '</tr>'
+    return out + '</table>'
+
+
+def option(argv, name, default=None):
+    return argv[argv.index(name) + 1] if name in argv else default
+
+
+def apc(argv, state):
+    """Applies one command to the state, and returns (exit code, output)."""
+    cmd = ' '.join(argv[:2])
+    if argv[:1] == ['target']:
+        return 0, 'Targeted  [https://fake.apcera.local]\nDefault namespace: "/sandbox/fake"\n'
+    if cmd == 'provider list':
+        return 0, html_table(['Name', 'Type', 'Namespace'], [['nfs', 'nfs', '/apcera/providers']])
+    if cmd == 'job list':
+        return 0, html_table(['Name', 'State'], [[name, job['state']] for name, job in sorted(state['jobs'].items())])
+    if cmd == 'network list':
+        return 0, html_table(['Network Name'], [[n] for n in sorted(state['networks'])])
+    if cmd == 'service list':
+        return 0, html_table(['Name'], [[s] for s in sorted(state['services'])])
+    if cmd == 'network show':
+        members = [name for name, job in state['jobs'].items() if argv[2] in job['networks']]
+        return (0, html_table(['Job'], [[m] for m in members])) if argv[2] in state['networks'] else (1, '')
+
+    if FAILURE_RATE and random.random() < FAILURE_RATE:
+        return 1, 'fake failure\n'
+
+    if cmd == 'docker run':
+        if argv[2] in state['jobs']:
+            return 1, 'job exists\n'
+        start = '--no-start' not in argv
+        state['jobs'][argv[2]] = {'state': 'started' if start else 'stopped', 'networks': [],
+                                  'image': option(argv, '-i'), 'args': option(argv, '-s')}
+    elif cmd in ('job start', 'job delete', 'job attract'):
+        if argv[2] not in state['jobs']:
+            return 1, 'no such job\n'
+        if cmd == 'job start':
+            state['jobs'][argv[2]]['state'] = 'started'
+        elif cmd == 'job delete':
+            del state['jobs'][argv[2]]
+    elif cmd == 'network create':
+        if argv[2] in state['networks']:
+            return 1, 'network exists\n'
+        state['networks'].append(argv[2])
+    elif cmd == 'network delete':
+        if argv[2] not in state['networks']:
+            return 1, 'no such network\n'
+        state['networks'].remove(argv[2])
+    elif cmd == 'network join':
+        job = option(argv, '--job')
+        if argv[2] not in state['networks'] or job not in state['jobs']:
+            return 1, 'no such job or network\n'
+        state['jobs'][job]['networks'].append(argv[2])
+    elif cmd == 'service create':
+        state['services'].append(argv[2])
+    elif cmd == 'service delete':
+        if argv[2] not in state['services']:
+            return 1, 'no such service\n'
+        state['services'].remove(argv[2])
+    elif cmd == 'service bind':
+        if argv[2] not in state['services'] or option(argv, '--job') not in state['jobs']:
+            return 1, 'no such job or service\n'
+    elif cmd == 'route add':
+        pass
+    else:
+        return 2, 'fake_apc: unsupported command: {}\n'.format(' '.join(argv))
+    return 0, ''
+
+
+def main():
+    argv = [a for a in sys.argv[1:] if a not in ('--html', '--batch')]
+    time.sleep(LATENCY)
+    with open(STATE + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(STATE) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = {'jobs': {}, 'networks': [], 'services': []}
+        code, output = apc(argv, state)
+        with open(STATE, 'w') as f:
+            json.dump(state, f, indent=2)
+    sys.stdout.write(output)
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Trains with N actor-learner threads in a single process, without a ps or any gRPC.  Every
+thread has its own env and local copy of the policy, like a worker of the distributed mode,
+and applies its gradients to the one global policy of the process without locking.
+
+    python hogwild.py --num-workers 8 --env-id PongDeterministic-v3 --log-dir /tmp/pong
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+import tensorflow as tf
+from a3c import A3C, FastSaver, use_tf12_api
+from envs import create_env, config_universe_logging
+from supervisor import status_path, write_status
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def learn(trainer, sess, sv, args):
+    """The loop of a learner thread; reports like a worker of the distributed mode does."""
+    status = status_path(args.log_dir, 'w-%d' % trainer.task)
+    last_report, last_env_steps = time.time(), 0
+    try:
+        while not sv.should_stop():
+            trainer.process(sess)
+            elapsed = time.time() - last_report
+            if elapsed > args.status_interval:
+                write_status(status, task=trainer.task, global_step=int(sess.run(trainer.global_step)),
+                             env_steps=trainer.env_steps, fps=(trainer.env_steps - last_env_steps) / elapsed)
+                last_report, last_env_steps = time.time(), trainer.env_steps
+    except Exception as e:
+        sv.request_stop(e)
+
+
+def run(args):
+    remotes = args.remotes.split(',') if args.remotes else [None] * args.num_workers
+    assert len(remotes) == args.num_workers, 'give one remote per thread'
+    trainers = []
+    for task in range(args.num_workers):
+        env = create_env(args.env_id, client_id=str(task), remotes=remotes[task])
+        trainers.append(A3C(env, task, optimizer=args.optimizer, distributed=False,
+                            shared=trainers[0] if trainers else None))
+
+    # Variable names that start with "local" are not saved in checkpoints.
+    if use_tf12_api:
+        variables_to_save = [v for v in tf.global_variables() if not v.name.startswith("local")]
+        init_op = tf.variables_initializer(variables_to_save)
+        init_all_op = tf.global_variables_initializer()
+    else:
+        variables_to_save = [v for v in tf.all_variables() if not v.name.startswith("local")]
+        init_op = tf.initialize_variables(variables_to_save)
+        init_all_op = tf.initialize_all_variables()
+
+    def init_fn(ses):
+        logger.info("Initializing all parameters.")
+        ses.run(init_all_op)
+
+    logdir = os.path.join(args.log_dir, 'vehicle')
+    if use_tf12_api:
+        summary_writer = tf.summary.FileWriter(logdir + "0")
+    else:
+        summary_writer = tf.train.SummaryWriter(logdir + "_0")
+    sv = tf.train.Supervisor(is_chief=True,
+                             logdir=logdir,
+                             saver=FastSaver(variables_to_save),
+                             summary_op=None,
+                             init_op=init_op,
+                             init_fn=init_fn,
+                             summary_writer=summary_writer,
+                             ready_op=tf.report_uninitialized_variables(variables_to_save),
+                             global_step=trainers[0].global_step,
+                             save_model_secs=30,
+                             save_summaries_secs=30)
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=args.intra_op_threads,
+                            inter_op_parallelism_threads=args.inter_op_threads)
+    with sv.managed_session('', config=config) as sess, sess.as_default():
+        for trainer in trainers:
+            trainer.start(sess, summary_writer)
+        logger.info("Starting %d learner threads at step=%d", len(trainers), sess.run(trainers[0].global_step))
+        threads = [threading.Thread(target=learn, args=(trainer, sess, sv, args)) for trainer in trainers]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        sv.wait_for_stop()
+    sv.stop()
+
+
+def main(_):
+    parser = argparse.ArgumentParser(description=None)
+    parser.add_argument('-w', '--num-workers', default=4, type=int, help='Number of actor-learner threads')
+    parser.add_argument('-e', '--env-id', default="PongDeterministic-v3", help='Environment id')
+    parser.add_argument('-l', '--log-dir', default="/tmp/pong", help='Log directory path')
+    parser.add_argument('-r', '--remotes', default=None,
+                        help='One remote per thread, as for worker.py (e.g. -r vnc://localhost:5900+15900,...)')
+    parser.add_argument('--log-universe', default=False, action="store_true",
+                        help='Save universe log to /tmp/univese-<pid>')
+    parser.add_argument('--optimizer', default='adam', choices=['adam', 'rmsprop'],
+                        help='Optimizer whose statistics all the threads share')
+    parser.add_argument('--status-interval', default=30.0, type=float,
+                        help='Seconds between updates of <log-dir>/status/w-<thread>.json')
+    parser.add_argument('--intra-op-threads', default=0, type=int, help='Size of the TF intra-op thread pool')
+    parser.add_argument('--inter-op-threads', default=0, type=int, help='Size of the TF inter-op thread pool')
+    args = parser.parse_args()
+
+    config_universe_logging(enable_logfile=args.log_universe)
+    run(args)
+
+
+if __name__ == "__main__":
+    tf.app.run()
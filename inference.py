@@ -0,0 +1,194 @@
+from __future__ import print_function
+import logging
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+import numpy as np
+import six.moves.queue as queue
+import tensorflow as tf
+from model import create_policy, PolicyConfig
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def parse_address(address):
+    """
+"host:port" is served over tcp, anything else is the path of a unix socket.
+"""
+    if not address.startswith('/') and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    return address
+
+
+class InferenceServer(object):
+    """
+Keeps a single copy of the policy per host and serves the actors of all the workers
+running on that host.  Requests that arrive within `max_wait` seconds of each other
+are evaluated together in one `sess.run`, up to `max_batch_size` actors at a time.
+"""
+    def __init__(self, policy, sync, max_batch_size=32, max_wait=0.002, sync_interval=0.25):
+        self.policy = policy
+        self.sync = sync
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.sync_interval = sync_interval
+        self.requests = queue.Queue()
+        self.ob_shape = policy.ob_space
+        self.num_actions = policy.ac_space
+        self.config = policy.config
+        policy.build_batch_step()
+
+    def handle(self, conn, hello=None):
+        """
+Serves one actor on its own thread.  Each actor has at most one request in flight.
+"""
+        thread = threading.Thread(target=self._handle, args=(conn, hello))
+        thread.daemon = True
+        thread.start()
+
+    def _handle(self, conn, hello):
+        reply = queue.Queue(1)
+        try:
+            if hello is None:
+                hello = conn.recv()
+            ob_shape, num_actions, config = hello
+            if list(ob_shape) != self.ob_shape or num_actions != self.num_actions or \
+                    PolicyConfig(*config) != self.config:
+                logger.error('Rejecting actor with ob_shape=%s num_actions=%s config=%s, '
+                             'serving ob_shape=%s num_actions=%s config=%s',
+                             ob_shape, num_actions, config, self.ob_shape, self.num_actions, self.config)
+                return
+            while True:
+                ob, features = conn.recv()
+                self.requests.put((ob, features, reply))
+                conn.send(reply.get())
+        except (EOFError, IOError):
+            pass
+        finally:
+            conn.close()
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def serve(self, sess):
+        pi = self.policy
+        fetches = [pi.batch_sample, pi.batch_vf] + pi.batch_state_out
+        last_sync = 0
+        num_batches = 0
+        num_requests = 0
+        last_log = time.time()
+
+        while True:
+            batch = self._next_batch()
+            if time.time() - last_sync > self.sync_interval:
+                sess.run(self.sync)
+                last_sync = time.time()
+
+            obs, features, replies = zip(*batch)
+            # every actor sends its observation with a batch dimension of 1
+            feed = {pi.batch_x: np.concatenate(obs)}
+            feed.update(zip(pi.batch_state_in, [np.concatenate(f) for f in zip(*features)]))
+            fetched = sess.run(fetches, feed)
+            sample, vf, states = fetched[0], fetched[1], fetched[2:]
+            # keep the shapes that the act of the policy returns for a single actor
+            for i, reply in enumerate(replies):
+                reply.put([sample[i], vf[i:i + 1]] + [state[i:i + 1] for state in states])
+
+            num_batches += 1
+            num_requests += len(batch)
+            if time.time() - last_log > 60:
+                logger.info('Served %d requests in %d batches (mean batch size %.2f)',
+                            num_requests, num_batches, float(num_requests) / num_batches)
+                num_batches = num_requests = 0
+                last_log = time.time()
+
+
+class RemotePolicy(object):
+    """
+Stands in for the local policy of a worker's RunnerThread, and forwards every
+act and value call to the inference server of the host.
+"""
+    def __init__(self, address, policy, connect_timeout=60.0):
+        self.state_init = policy.get_initial_features()
+        self.global_step = policy.global_step
+
+        deadline = time.time() + connect_timeout
+        while True:
+            try:
+                self.conn = Client(parse_address(address))
+                break
+            except (IOError, OSError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(1.0)
+        self.conn.send((policy.ob_space, policy.ac_space, tuple(policy.config)))
+
+    def get_initial_features(self):
+        return self.state_init
+
+    def act(self, ob, *features):
+        self.conn.send((np.asarray([ob], np.float32), features))
+        return self.conn.recv()
+
+    def value(self, ob, *features):
+        return self.act(ob, *features)[1][0]
+
+
+def run(args, server):
+    """
+The logic of the inference job.  The first actor to connect tells us the shapes and the
+architecture of the policy, after which the graph is built and the server waits for the ps to be initialized.
+"""
+    address = parse_address(args.inference_address)
+    if isinstance(address, str) and os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address)
+    logger.info('Waiting for the first actor on %s', args.inference_address)
+    conn = listener.accept()
+    hello = conn.recv()
+    ob_shape, num_actions, config = hello
+
+    inference_device = "/job:inference/task:0/cpu:0"
+    with tf.device(tf.train.replica_device_setter(1, worker_device=inference_device)):
+        with tf.variable_scope("global"):
+            network = create_policy(ob_shape, num_actions, config)
+    with tf.device(inference_device):
+        with tf.variable_scope("local"):
+            policy = create_policy(ob_shape, num_actions, config)
+        sync = tf.group(*[v1.assign(v2) for v1, v2 in zip(policy.var_list, network.var_list)])
+        inference_server = InferenceServer(policy, sync,
+                                           max_batch_size=args.inference_batch_size,
+                                           max_wait=args.inference_max_wait)
+    uninitialized = tf.report_uninitialized_variables(network.var_list)
+
+    config = tf.ConfigProto(device_filters=["/job:ps", inference_device])
+    sess = tf.Session(server.target, config=config)
+    while len(sess.run(uninitialized)) > 0:
+        logger.info('Waiting for the parameter server to be initialized')
+        time.sleep(1.0)
+
+    inference_server.handle(conn, hello)
+
+    def accept():
+        while True:
+            inference_server.handle(listener.accept())
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+
+    logger.info('Serving inference on %s', args.inference_address)
+    with sess.as_default():
+        inference_server.serve(sess)
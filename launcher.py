@@ -0,0 +1,155 @@
+"""
+Starts the processes of a training session on the hosts of their cluster addresses over ssh,
+for train.py --mode ssh.  All the processes are started at once.  The output of every process
+is streamed back into <logdir>/a3c.<name>.out on the launching host, and the launch waits
+until each process has logged that it is ready.
+"""
+from __future__ import print_function
+import logging
+import os
+import re
+import shlex
+import subprocess
+import time
+from six.moves import shlex_quote
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# what each kind of process logs once it is ready (see worker.py and inference.py)
+READY_PATTERNS = {
+    'ps': re.compile(r'Parameter server ready'),
+    'inf': re.compile(r'Serving inference on'),
+    'w': re.compile(r'Starting training at step'),
+}
+
+
+def host_of(address):
+    return address.rsplit(':', 1)[0]
+
+
+def process_hosts(procs, workers):
+    """The host of every (name, cmd) of create_process_cmds: the ps and the inference server run on the host of the ps."""
+    hosts = {}
+    for name, _ in procs:
+        if name.startswith('w-'):
+            hosts[name] = host_of(workers[1 + int(name[2:])])
+        else:
+            hosts[name] = host_of(workers[0])
+    return hosts
+
+
+def ssh_argv(ssh, host, cmd):
+    if isinstance(cmd, (list, tuple)):
+        cmd = ' '.join(shlex_quote(str(v)) for v in cmd)
+    return shlex.split(ssh) + [host, cmd]
+
+
+def ssh_command(ssh, host, cmd):
+    """ssh_argv as a shell command line."""
+    return ' '.join(shlex_quote(arg) for arg in ssh_argv(ssh, host, cmd))
+
+
+def pid_path(logdir, name):
+    return os.path.join(logdir, '{}.pid'.format(name))
+
+
+def remote_command(name, cmd, logdir, remote_dir):
+    """
+Runs cmd in remote_dir, after writing its pid to <logdir>/<name>.pid on the remote host, so that
+it can be killed without the ssh connection.
+"""
+    cmd = ' '.join(shlex_quote(str(v)) for v in cmd)
+    # env, since the command can start with variable assignments, which exec does not take
+    return 'mkdir -p {0} && cd {1} && echo $$ >{2} && exec env {3}'.format(
+        shlex_quote(logdir), shlex_quote(remote_dir), shlex_quote(pid_path(logdir, name)), cmd)
+
+
+def kill_command(ssh, host, name, logdir):
+    return ssh_command(ssh, host, 'kill $(cat {})'.format(shlex_quote(pid_path(logdir, name))))
+
+
+class RemoteProcess(object):
+    def __init__(self, name, cmd, host, logdir, ssh, remote_dir):
+        self.name = name
+        self.cmd = cmd
+        self.host = host
+        self.logdir = logdir
+        self.ssh = ssh
+        self.remote_dir = remote_dir
+        self.out_path = os.path.join(logdir, 'a3c.{}.out'.format(name))
+        self.ready_pattern = READY_PATTERNS[name.split('-')[0]]
+        self.proc = None
+        self.ready = False
+
+    def argv(self):
+        return ssh_argv(self.ssh, self.host, remote_command(self.name, self.cmd, self.logdir, self.remote_dir))
+
+    def start(self):
+        out = open(self.out_path, 'a')
+        self.proc = subprocess.Popen(self.argv(), stdin=open(os.devnull), stdout=out, stderr=subprocess.STDOUT)
+
+    def check_ready(self):
+        if not self.ready:
+            with open(self.out_path) as f:
+                self.ready = self.ready_pattern.search(f.read()) is not None
+        return self.ready
+
+    def tail(self, lines=10):
+        with open(self.out_path) as f:
+            return ''.join(f.readlines()[-lines:])
+
+
+class SshLauncher(object):
+    """
+Starts the given (name, cmd) processes on their hosts, each through an ssh connection of its own.
+`ssh` is the ssh command (options included), and `remote_dir` the directory of this repo on the
+hosts.  `kill.sh` in logdir kills them all.
+"""
+    def __init__(self, procs, hosts, logdir, ssh='ssh -o BatchMode=yes', remote_dir=None):
+        remote_dir = remote_dir or os.getcwd()
+        self.procs = [RemoteProcess(name, cmd, hosts[name], logdir, ssh, remote_dir) for name, cmd in procs]
+        self.logdir = logdir
+        self.ssh = ssh
+
+    def commands(self):
+        """The equivalent shell commands, for train.py --dry-run."""
+        return ['{} >>{} 2>&1 &'.format(' '.join(shlex_quote(arg) for arg in p.argv()), shlex_quote(p.out_path))
+                for p in self.procs]
+
+    def start(self):
+        if not os.path.exists(self.logdir):
+            os.makedirs(self.logdir)
+        with open(os.path.join(self.logdir, 'kill.sh'), 'a') as f:
+            for p in self.procs:
+                f.write(kill_command(self.ssh, p.host, p.name, p.logdir) + '\n')
+        for p in self.procs:
+            logger.info('Starting %s on %s', p.name, p.host)
+            p.start()
+
+    def wait_ready(self, timeout=900.0, poll_interval=1.0):
+        """
+Waits until every process has logged that it is ready.  Returns the names of the processes that
+exited or were not ready within `timeout` seconds (an empty list when all of them are ready).
+"""
+        deadline = time.time() + timeout
+        pending = list(self.procs)
+        failed = []
+        last_log = 0
+        while pending and time.time() < deadline:
+            for p in list(pending):
+                if p.check_ready():
+                    logger.info('%s on %s is ready', p.name, p.host)
+                    pending.remove(p)
+                elif p.proc.poll() is not None:
+                    logger.error('%s on %s exited with code %s:\n%s', p.name, p.host, p.proc.returncode, p.tail())
+                    pending.remove(p)
+                    failed.append(p.name)
+            if pending and time.time() - last_log > 30:
+                logger.info('%d of %d processes ready, waiting for %s', len(self.procs) - len(pending) - len(failed),
+                            len(self.procs), ' '.join(p.name for p in pending))
+                last_log = time.time()
+            time.sleep(poll_interval)
+        for p in pending:
+            logger.error('%s on %s is not ready after %.0fs:\n%s', p.name, p.host, timeout, p.tail())
+        return failed + [p.name for p in pending]
@@ -0,0 +1,172 @@
+"""
+Periodic memory telemetry for the long-running processes of a training session.  A MemoryTracker
+thread reports the RSS of its process, the number of live Python objects of the most common types,
+the allocator stats of TensorFlow devices (when this TF version has them) and the size of queues to
+TensorBoard.  With a threshold, it also takes tracemalloc snapshots and writes the allocations that
+grew the most each time the RSS grows by more than the threshold.  rss_mb and peak_rss_mb are
+also used by benchmark.py, so tensorflow is only imported by what needs it.
+"""
+from __future__ import print_function
+import gc
+import logging
+import os
+import resource
+import threading
+import time
+from collections import Counter
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def rss_mb(pid='self'):
+    """Current resident set size of a process (this one by default), in MB."""
+    with open('/proc/{}/statm'.format(pid)) as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / (1024. * 1024.)
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def object_counts(top=10):
+    """The `top` most common types of the objects tracked by the garbage collector, and the total."""
+    counts = Counter(type(o).__name__ for o in gc.get_objects())
+    return counts.most_common(top), sum(counts.values())
+
+
+def allocator_stats_ops(device):
+    """
+The bytes in use and the peak of the TF allocator of `device`, or None when this TF version does
+not have the memory_stats ops.
+"""
+    import tensorflow as tf
+    try:
+        from tensorflow.contrib import memory_stats
+    except ImportError:
+        return None
+    with tf.device(device):
+        return [memory_stats.BytesInUse(), memory_stats.MaxBytesInUse()]
+
+
+class MemoryTracker(threading.Thread):
+    """
+Collects the memory telemetry of this process every `interval` seconds, and writes it as the
+memory/* summaries of `summary_writer`.  `queues` maps names to the queues whose size is reported, and
+`devices` are the TF devices whose allocator stats are read through the session given to `start`.
+With `threshold_mb`, the top growing allocations since the last snapshot are logged and written
+to <logdir>/memtrack/<name>-<n>.txt whenever the RSS has grown by more than that since then.
+"""
+    def __init__(self, name, summary_writer, interval=120.0, queues=None, devices=(), threshold_mb=None,
+                 logdir=None, top=10):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = 'memtrack-' + name
+        self.tracker_name = name
+        self.summary_writer = summary_writer
+        self.interval = interval
+        self.queues = dict(queues or {})
+        self.threshold_mb = threshold_mb
+        self.logdir = logdir
+        self.top = top
+        self.sess = None
+        self.global_step = None
+        self._num_reports = 0
+        self._allocator_ops = []
+        for device in devices:
+            ops = allocator_stats_ops(device)
+            if ops is None:
+                logger.info('MemoryTracker: this TF version has no memory_stats ops, not reporting allocator stats')
+                break
+            self._allocator_ops.append((device, ops))
+
+        self._snapshot = None
+        if threshold_mb is not None:
+            if tracemalloc is None:
+                logger.warn('MemoryTracker: tracemalloc needs python 3.4 or newer, not diffing snapshots')
+            else:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(25)
+                self._snapshot = tracemalloc.take_snapshot()
+        self._snapshot_rss = rss_mb()
+
+    def start_tracking(self, sess=None, global_step=None):
+        """Starts the thread; `global_step` is the tensor the summaries are written at, if any."""
+        self.sess = sess
+        self.global_step = global_step
+        self.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.report()
+            except Exception:
+                logger.exception('MemoryTracker: failed to report')
+
+    def _allocator_stats(self):
+        import tensorflow as tf
+        stats = []
+        for device, ops in list(self._allocator_ops):
+            try:
+                in_use, peak = self.sess.run(ops)
+            except tf.errors.OpError as e:
+                logger.info('MemoryTracker: no allocator stats for %s, not asking again (%s)', device, e.message)
+                self._allocator_ops.remove((device, ops))
+                continue
+            name = device.strip('/').replace('/', '_').replace(':', '_')
+            stats += [('memory/tf/{}/bytes_in_use_mb'.format(name), in_use / (1024. * 1024.)),
+                      ('memory/tf/{}/max_bytes_in_use_mb'.format(name), peak / (1024. * 1024.))]
+        return stats
+
+    def report(self):
+        import tensorflow as tf
+        rss = rss_mb()
+        stats = [('memory/rss_mb', rss), ('memory/peak_rss_mb', peak_rss_mb())]
+        counts, total = object_counts(self.top)
+        stats.append(('memory/objects/total', total))
+        stats += [('memory/objects/{}'.format(type_name), count) for type_name, count in counts]
+        stats += [('memory/queue/{}'.format(name), q.qsize()) for name, q in sorted(self.queues.items())]
+        if self.sess is not None:
+            stats += self._allocator_stats()
+
+        step = self._num_reports
+        if self.sess is not None and self.global_step is not None:
+            step = self.sess.run(self.global_step)
+        self._num_reports += 1
+        summary = tf.Summary()
+        for tag, value in stats:
+            summary.value.add(tag=tag, simple_value=float(value))
+        self.summary_writer.add_summary(summary, step)
+        self.summary_writer.flush()
+        logger.info('MemoryTracker: rss %.1fMB, %d objects (%s)', rss, total,
+                    ', '.join('{} {}'.format(type_name, count) for type_name, count in counts[:3]))
+
+        if self.threshold_mb is not None and rss - self._snapshot_rss > self.threshold_mb:
+            self.diff_snapshot(rss)
+
+    def diff_snapshot(self, rss):
+        """Logs the allocations that grew the most since the last snapshot, and takes a new one."""
+        logger.warn('MemoryTracker: rss grew from %.1fMB to %.1fMB', self._snapshot_rss, rss)
+        self._snapshot_rss = rss
+        if self._snapshot is None:
+            return
+        snapshot = tracemalloc.take_snapshot()
+        lines = ['rss {:.1f}MB, top {} allocations by growth since the last snapshot:'.format(rss, self.top)]
+        lines += [str(stat) for stat in snapshot.compare_to(self._snapshot, 'lineno')[:self.top]]
+        self._snapshot = snapshot
+        logger.warn('MemoryTracker: %s', '\n'.join(lines))
+        if self.logdir:
+            directory = os.path.join(self.logdir, 'memtrack')
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, '{}-{}.txt'.format(self.tracker_name, self._num_reports))
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
@@ -1,6 +1,12 @@
+import time
+from collections import namedtuple
 import numpy as np
 import tensorflow as tf
 import tensorflow.contrib.rnn as rnn
+import distutils.version
+
+# the scope dynamic_rnn puts the cell variables in by default, which the single step paths re-enter
+RNN_SCOPE = "rnn" if distutils.version.LooseVersion(tf.VERSION) >= distutils.version.LooseVersion('1.0.0') else "RNN"
 
 def normalized_columns_initializer(std=1.0):
     def _initializer(shape, dtype=None, partition_info=None):
@@ -38,21 +44,115 @@ def linear(x, size, name, initializer=None, bias_init=0):
     b = tf.get_variable(name + "/b", [size], initializer=tf.constant_initializer(bias_init))
     return tf.matmul(x, w) + b
 
-def categorical_sample(logits, d):
+def categorical_sample(logits):
+    """The index of an action sampled from every row of logits, as int32."""
     value = tf.squeeze(tf.multinomial(logits - tf.reduce_max(logits, [1], keep_dims=True), 1), [1])
-    return tf.one_hot(value, d)
+    return tf.to_int32(value)
+
+# The conv layers are 3x3 with the given filters and strides, and are preceded by an average
+# pooling of the input by `downsample` when it is larger than 1.  policy is 'lstm' for LSTMPolicy,
+# or 'ff' for FFPolicy, whose hidden layer has lstm_size units.  The observations are the last
+# `frames` frames of the env, stacked along the channels (see envs.FrameStack).
+PolicyConfig = namedtuple('PolicyConfig', ['filters', 'strides', 'downsample', 'lstm_size', 'policy', 'frames'])
+# configs written before the policy and frames fields existed are those of LSTMPolicy on single frames
+PolicyConfig.__new__.__defaults__ = ('lstm', 1)
+DEFAULT_POLICY_CONFIG = PolicyConfig((32, 32, 32, 32), (2, 2, 2, 2), 1, 256)
+
+def create_policy(ob_space, ac_space, config=None):
+    config = PolicyConfig(*(config or DEFAULT_POLICY_CONFIG))
+    if config.policy == 'ff':
+        return FFPolicy(ob_space, ac_space, config)
+    assert config.policy == 'lstm', config.policy
+    return LSTMPolicy(ob_space, ac_space, config)
+
+class ConvPolicy(object):
+    """
+The input and the conv layers shared by the policies.  A policy has the placeholders of its state
+in state_in (batch_state_in for build_batch_step), and act returns the action, the value and the
+next state; a policy without state has none.
+"""
+    def __init__(self, ob_space, ac_space, config=None):
+        self.ob_space = list(ob_space)
+        self.ac_space = ac_space
+        config = PolicyConfig(*(config or DEFAULT_POLICY_CONFIG))
+        self.config = config._replace(filters=tuple(config.filters), strides=tuple(config.strides))
+        assert len(self.config.filters) == len(self.config.strides)
+        self.x = tf.placeholder(tf.float32, [None] + list(ob_space))
+        self.scope = tf.get_variable_scope()
+        # (name, output, flops per frame) of every layer of the act path, see profile_policy
+        self.layers = []
+
+    def _convs(self, x, layers=None):
+        layers = [] if layers is None else layers
+        d = self.config.downsample
+        if d > 1:
+            x = tf.nn.avg_pool(x, [1, d, d, 1], [1, d, d, 1], "SAME")
+            layers.append(("downsample", x, np.prod(self.ob_space)))
+        for i, (num_filters, stride) in enumerate(zip(self.config.filters, self.config.strides)):
+            num_inputs = int(x.get_shape()[3])
+            x = tf.nn.elu(conv2d(x, num_filters, "l{}".format(i + 1), [3, 3], [stride, stride]))
+            # a multiply and an add per weight, for every output position
+            _, height, width, _ = x.get_shape().as_list()
+            layers.append(("l{}".format(i + 1), x, 2 * height * width * 3 * 3 * num_inputs * num_filters))
+        return flatten(x)
+
+    def get_initial_features(self):
+        return self.state_init
+
+class FFPolicy(ConvPolicy):
+    """
+A feed-forward policy: the conv layers, one fully connected layer and the action and value heads,
+with no recurrent state.  The env stacks the last few frames into every observation
+(PolicyConfig.frames), which is all the policy knows of the past.  Every row of x is independent,
+so the act path is also the batch path of build_batch_step.
+"""
+    def __init__(self, ob_space, ac_space, config=None):
+        super(FFPolicy, self).__init__(ob_space, ac_space, config)
+        size = self.config.lstm_size
+        features = self._convs(self.x, self.layers)
+        hidden = tf.nn.elu(linear(features, size, "fc", normalized_columns_initializer(1.0)))
+        self.logits = linear(hidden, ac_space, "action", normalized_columns_initializer(0.01))
+        self.vf = tf.reshape(linear(hidden, 1, "value", normalized_columns_initializer(1.0)), [-1])
+        self.sample = categorical_sample(self.logits)[0]
+
+        self.state_init = []
+        self.state_in = []
+        self.state_out = []
+        self.step_sample, self.step_vf, self.step_state_out = self.sample, self.vf, []
 
-class LSTMPolicy(object):
-    def __init__(self, ob_space, ac_space):
-        self.x = x = tf.placeholder(tf.float32, [None] + list(ob_space))
+        num_features = int(features.get_shape()[1])
+        self.layers += [("fc", hidden, 2 * num_features * size),
+                        ("action", self.logits, 2 * size * ac_space),
+                        ("value", self.vf, 2 * size)]
+        self.var_list = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, tf.get_variable_scope().name)
+
+    def build_batch_step(self):
+        self.batch_x = self.x
+        self.batch_state_in = []
+        self.batch_logits = self.logits
+        self.batch_vf = self.vf
+        self.batch_state_out = []
+        self.batch_sample = categorical_sample(self.logits)
+
+    def act(self, ob):
+        sess = tf.get_default_session()
+        return sess.run([self.sample, self.vf], {self.x: [ob]})
+
+    def value(self, ob):
+        sess = tf.get_default_session()
+        return sess.run(self.vf, {self.x: [ob]})[0]
 
-        for i in range(4):
-            x = tf.nn.elu(conv2d(x, 32, "l{}".format(i + 1), [3, 3], [2, 2]))
+class LSTMPolicy(ConvPolicy):
+    def __init__(self, ob_space, ac_space, config=None):
+        super(LSTMPolicy, self).__init__(ob_space, ac_space, config)
+        config = self.config
+        x = self.x
         # introduce a "fake" batch dimension of 1 after flatten so that we can do LSTM over time dim
-        x = tf.expand_dims(flatten(x), [0])
+        features = self._convs(x, self.layers)
+        x = tf.expand_dims(features, [0])
 
-        size = 256
-        lstm = rnn.rnn_cell.BasicLSTMCell(size, state_is_tuple=True)
+        size = config.lstm_size
+        self.lstm = lstm = rnn.rnn_cell.BasicLSTMCell(size, state_is_tuple=True)
         self.state_size = lstm.state_size
         step_size = tf.shape(self.x)[:1]
 
@@ -66,23 +166,163 @@ class LSTMPolicy(object):
         state_in = rnn.rnn_cell.LSTMStateTuple(c_in, h_in)
         lstm_outputs, lstm_state = tf.nn.dynamic_rnn(
             lstm, x, initial_state=state_in, sequence_length=step_size,
-            time_major=False)
+            time_major=False, scope=RNN_SCOPE)
         lstm_c, lstm_h = lstm_state
         x = tf.reshape(lstm_outputs, [-1, size])
         self.logits = linear(x, ac_space, "action", normalized_columns_initializer(0.01))
         self.vf = tf.reshape(linear(x, 1, "value", normalized_columns_initializer(1.0)), [-1])
         self.state_out = [lstm_c[:1, :], lstm_h[:1, :]]
-        self.sample = categorical_sample(self.logits, ac_space)[0, :]
+        self.sample = categorical_sample(self.logits)[0]
+
+        # act and value take a single step, so they skip the while loop of dynamic_rnn and call the
+        # cell directly on the [1, features] conv output, with the variables of the sequence path
+        with tf.variable_scope(self.scope, reuse=True):
+            step_out, step_state, step_logits, self.step_vf = self._step(features, state_in)
+        self.step_state_out = list(step_state)
+        self.step_sample = categorical_sample(step_logits)[0]
+
+        num_features = int(features.get_shape()[1])
+        self.layers += [("lstm", step_out, 2 * 4 * size * (num_features + size)),
+                        ("action", step_logits, 2 * size * ac_space),
+                        ("value", self.step_vf, 2 * size)]
         self.var_list = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, tf.get_variable_scope().name)
 
-    def get_initial_features(self):
-        return self.state_init
+    def _step(self, features, state_in):
+        with tf.variable_scope(RNN_SCOPE):
+            x, state = self.lstm(features, state_in)
+        logits = linear(x, self.ac_space, "action")
+        vf = tf.reshape(linear(x, 1, "value"), [-1])
+        return x, state, logits, vf
+
+    def build_batch_step(self):
+        """
+Adds a second forward path that shares the variables of this policy, but treats
+every row of its input as an independent actor taking a single step.  This lets
+an inference server evaluate many actors (each with its own LSTM state) in one run.
+"""
+        with tf.variable_scope(self.scope, reuse=True):
+            self.batch_x = tf.placeholder(tf.float32, [None] + self.ob_space)
+            c_in = tf.placeholder(tf.float32, [None, self.lstm.state_size.c])
+            h_in = tf.placeholder(tf.float32, [None, self.lstm.state_size.h])
+            self.batch_state_in = [c_in, h_in]
+
+            state_in = rnn.rnn_cell.LSTMStateTuple(c_in, h_in)
+            _, lstm_state, self.batch_logits, self.batch_vf = self._step(self._convs(self.batch_x), state_in)
+            self.batch_state_out = list(lstm_state)
+            self.batch_sample = categorical_sample(self.batch_logits)
 
     def act(self, ob, c, h):
         sess = tf.get_default_session()
-        return sess.run([self.sample, self.vf] + self.state_out,
+        return sess.run([self.step_sample, self.step_vf] + self.step_state_out,
                         {self.x: [ob], self.state_in[0]: c, self.state_in[1]: h})
 
     def value(self, ob, c, h):
         sess = tf.get_default_session()
-        return sess.run(self.vf, {self.x: [ob], self.state_in[0]: c, self.state_in[1]: h})[0]
+        return sess.run(self.step_vf, {self.x: [ob], self.state_in[0]: c, self.state_in[1]: h})[0]
+
+
+def profile_policy(ob_space, ac_space, config=None, steps=200):
+    """
+Builds the policy in a graph of its own, and measures the FLOPs and the single-threaded
+latency of every layer of a single act step.  The latency of a layer is the time it takes
+to compute up to and including it, minus the same for the layer before.
+"""
+    graph = tf.Graph()
+    with graph.as_default():
+        policy = create_policy(ob_space, ac_space, config)
+        init = tf.global_variables_initializer() if hasattr(tf, 'global_variables_initializer') \
+            else tf.initialize_all_variables()
+    sess = tf.Session(graph=graph, config=tf.ConfigProto(intra_op_parallelism_threads=1,
+                                                         inter_op_parallelism_threads=1))
+    sess.run(init)
+    feed = {policy.x: [np.random.uniform(size=ob_space).astype(np.float32)]}
+    feed.update(zip(policy.state_in, policy.get_initial_features()))
+
+    def latency(fetches):
+        sess.run(fetches, feed)
+        start = time.time()
+        for _ in range(steps):
+            sess.run(fetches, feed)
+        return (time.time() - start) / steps
+
+    layers, previous = [], 0.0
+    for name, output, flops in policy.layers:
+        cumulative = latency(output)
+        layers.append({'name': name, 'shape': output.get_shape().as_list(), 'flops': int(flops),
+                       'ms': 1000 * max(0.0, cumulative - previous)})
+        previous = cumulative
+    act_ms = 1000 * latency([policy.step_sample, policy.step_vf] + policy.step_state_out)
+    sess.close()
+    return {'config': policy.config._asdict(), 'ob_space': list(ob_space), 'ac_space': ac_space,
+            'layers': layers, 'flops': sum(l['flops'] for l in layers), 'act_ms': act_ms}
+
+def format_profile(profile):
+    lines = ['{:<12} {:>20} {:>14} {:>9}'.format('layer', 'output', 'MFLOPs', 'ms')]
+    for l in profile['layers']:
+        lines.append('{:<12} {:>20} {:>14.2f} {:>9.3f}'.format(
+            l['name'], 'x'.join(str(d) for d in l['shape'][1:]), l['flops'] / 1e6, l['ms']))
+    lines.append('{:<12} {:>20} {:>14.2f} {:>9.3f}'.format('act', '', profile['flops'] / 1e6, profile['act_ms']))
+    return '\n'.join(lines)
+
+
+class FrozenPolicy(object):
+    """
+A pruned copy of the act/value subgraph of a policy.  It runs in a graph and session of its
+own, so acting does not touch the gradient ops, summaries or the replica_device_setter
+variable reads of the training graph.  The copy is built once, with a variable of its own
+in place of every weight of the policy, and `refresh` assigns the current weights of the
+policy to them.  Like the sync of the local network, an act can run during a refresh.
+"""
+    def __init__(self, policy):
+        self.state_init = policy.get_initial_features()
+        self.global_step = None
+        self._inputs = [policy.x] + policy.state_in
+        self._outputs = [policy.step_sample, policy.step_vf] + policy.step_state_out
+        self._variables = policy.var_list
+        self._frozen = None
+
+    def _build(self, sess):
+        graph_def = tf.graph_util.extract_sub_graph(sess.graph.as_graph_def(), [t.op.name for t in self._outputs])
+        for node in graph_def.node:
+            node.device = ""
+
+        graph = tf.Graph()
+        with graph.as_default():
+            # the weights are fed to the initializers of the variables that replace them, which
+            # are run again by every refresh
+            self._weights_in = [tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in self._variables]
+            weights = [tf.Variable(w, trainable=False) for w in self._weights_in]
+            self._assign = [w.initializer for w in weights]
+            elements = tf.import_graph_def(graph_def, name="",
+                                           input_map=dict((v.value().name, w.value())
+                                                          for v, w in zip(self._variables, weights)),
+                                           return_elements=[t.name for t in self._inputs + self._outputs])
+        config = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)
+        return tf.Session(graph=graph, config=config), elements[:len(self._inputs)], elements[len(self._inputs):]
+
+    def refresh(self, sess):
+        """Copies the weights of the policy in sess to the frozen copy, which is built on the first call."""
+        if self._frozen is None:
+            self._frozen = self._build(sess)
+        self._frozen[0].run(self._assign, dict(zip(self._weights_in, sess.run(self._variables))))
+
+    def close(self):
+        if self._frozen is not None:
+            self._frozen[0].close()
+            self._frozen = None
+
+    def get_initial_features(self):
+        return self.state_init
+
+    def _feed(self, inputs, ob, features):
+        feed = {inputs[0]: [ob]}
+        feed.update(zip(inputs[1:], features))
+        return feed
+
+    def act(self, ob, *features):
+        sess, inputs, outputs = self._frozen
+        return sess.run(outputs, self._feed(inputs, ob, features))
+
+    def value(self, ob, *features):
+        sess, inputs, outputs = self._frozen
+        return sess.run(outputs[1], self._feed(inputs, ob, features))[0]
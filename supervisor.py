@@ -0,0 +1,175 @@
+"""
+Keeps the processes of a training session alive for train.py --mode supervise.  Crashed
+or hung processes are restarted with exponential backoff, and workers whose throughput falls
+well below the median of the cluster are flagged.
+"""
+from __future__ import print_function
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from six.moves import shlex_quote
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def status_path(logdir, name):
+    return os.path.join(logdir, 'status', '{}.json'.format(name))
+
+
+def leave_path(logdir, name):
+    """A worker that finds this file stops, and is not restarted (train.py --leave)."""
+    return os.path.join(logdir, 'status', '{}.leave'.format(name))
+
+
+def write_status(path, **status):
+    """Atomically replaces the status file of a process; read by the supervisor."""
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    status['time'] = time.time()
+    status['pid'] = os.getpid()
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(status, f)
+    os.rename(tmp, path)
+
+
+def read_status(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class SupervisedProcess(object):
+    def __init__(self, name, cmd, logdir):
+        self.name = name
+        self.cmd = cmd if isinstance(cmd, str) else ' '.join(shlex_quote(str(v)) for v in cmd)
+        self.logdir = logdir
+        self.proc = None
+        self.started = 0
+        self.restarts = 0
+        self.failures = 0
+        self.restart_at = None
+
+    def start(self):
+        out = open(os.path.join(self.logdir, 'a3c.{}.out'.format(self.name)), 'a')
+        # a session of its own, so that the whole process group (shell included) can be killed
+        self.proc = subprocess.Popen(self.cmd, shell=True, stdout=out, stderr=subprocess.STDOUT,
+                                     preexec_fn=os.setsid)
+        self.started = time.time()
+        self.restart_at = None
+
+    def kill(self, sig=signal.SIGTERM):
+        if self.proc is not None and self.proc.poll() is None:
+            try:
+                os.killpg(self.proc.pid, sig)
+            except OSError:
+                pass
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+
+class ProcessSupervisor(object):
+    """
+Runs the given (name, cmd) processes.  Workers are expected to report their throughput
+with write_status(status_path(logdir, name), fps=...); a worker whose status goes stale
+for `heartbeat_timeout` seconds is considered hung and restarted.
+"""
+    def __init__(self, procs, logdir, straggler_ratio=0.5, heartbeat_timeout=600.0,
+                 report_interval=60.0, min_backoff=5.0, max_backoff=300.0, stable_after=600.0):
+        self.procs = [SupervisedProcess(name, cmd, logdir) for name, cmd in procs]
+        self.logdir = logdir
+        self.straggler_ratio = straggler_ratio
+        self.heartbeat_timeout = heartbeat_timeout
+        self.report_interval = report_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+
+    def _restart_later(self, p, reason):
+        if time.time() - p.started > self.stable_after:
+            p.failures = 0
+        backoff = min(self.max_backoff, self.min_backoff * 2 ** p.failures)
+        p.failures += 1
+        p.restart_at = time.time() + backoff
+        logger.warning('%s %s, restarting in %.0fs', p.name, reason, backoff)
+
+    def check(self):
+        now = time.time()
+        for p in list(self.procs):
+            if p.restart_at is not None:
+                if now >= p.restart_at:
+                    p.restarts += 1
+                    p.start()
+            elif not p.alive():
+                if os.path.exists(leave_path(self.logdir, p.name)):
+                    logger.info('%s left the session', p.name)
+                    self.procs.remove(p)
+                    continue
+                self._restart_later(p, 'exited with code {}'.format(p.proc.returncode))
+            else:
+                status = read_status(status_path(self.logdir, p.name))
+                if status is not None and status['time'] > p.started and now - status['time'] > self.heartbeat_timeout:
+                    p.kill(signal.SIGKILL)
+                    self._restart_later(p, 'stopped reporting for {:.0f}s'.format(now - status['time']))
+
+    def summary(self):
+        now = time.time()
+        workers = {}
+        for p in self.procs:
+            status = read_status(status_path(self.logdir, p.name))
+            fresh = status is not None and now - status['time'] < self.heartbeat_timeout
+            workers[p.name] = {'alive': p.alive(), 'restarts': p.restarts,
+                               'fps': status.get('fps') if fresh else None,
+                               'global_step': status.get('global_step') if fresh else None}
+
+        rates = sorted(w['fps'] for w in workers.values() if w['fps'] is not None)
+        median = rates[len(rates) // 2] if rates else None
+        stragglers = []
+        for name, w in sorted(workers.items()):
+            w['straggler'] = bool(median and w['fps'] is not None and w['fps'] < self.straggler_ratio * median)
+            if w['straggler']:
+                stragglers.append(name)
+        return {'time': now, 'median_fps': median, 'total_fps': sum(rates),
+                'stragglers': stragglers, 'processes': workers}
+
+    def report(self):
+        summary = self.summary()
+        path = os.path.join(self.logdir, 'throughput.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(summary, f, indent=2)
+        os.rename(path + '.tmp', path)
+
+        logger.info('Cluster throughput: %.1f fps total, %s fps median',
+                    summary['total_fps'], summary['median_fps'])
+        for name in summary['stragglers']:
+            logger.warning('%s is a straggler: %.1f fps against a median of %.1f fps',
+                           name, summary['processes'][name]['fps'], summary['median_fps'])
+
+    def run(self, poll_interval=1.0):
+        def shutdown(sig, _):
+            logger.warning('Received signal %s: stopping all processes', sig)
+            for p in self.procs:
+                p.kill()
+            sys.exit(128 + sig)
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGHUP, shutdown)
+
+        for p in self.procs:
+            p.start()
+        last_report = time.time()
+        while True:
+            time.sleep(poll_interval)
+            self.check()
+            if time.time() - last_report > self.report_interval:
+                self.report()
+                last_report = time.time()
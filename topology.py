@@ -0,0 +1,181 @@
+"""
+CPU topology detection and process placement for train.py.  Every process of a session
+(ps, inference server, workers) gets a disjoint set of cores, taken from a single NUMA
+node whenever possible, and TF thread pools sized to that set.
+"""
+from __future__ import print_function
+import glob
+import json
+import multiprocessing
+import os
+import re
+import signal
+import subprocess
+import time
+from collections import namedtuple
+from six.moves import shlex_quote
+
+
+def parse_cpulist(cpulist):
+    """Parses the kernel's cpu list format, e.g. "0-3,8-11"."""
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus += range(int(lo), int(hi) + 1)
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    return ','.join(str(c) for c in cpus)
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def numa_nodes():
+    """
+The cpus we are allowed to run on, grouped by NUMA node.  Falls back to a single node
+on machines (or containers) that do not expose the node topology.
+"""
+    allowed = set(available_cpus())
+    paths = sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                   key=lambda p: int(re.search(r'node(\d+)', p).group(1)))
+    nodes = []
+    for path in paths:
+        with open(path) as f:
+            cpus = [c for c in parse_cpulist(f.read()) if c in allowed]
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(allowed)]
+
+
+# ps_cores is also the number of cores given to the inference server.
+Layout = namedtuple('Layout', ['name', 'pin', 'ps_cores', 'worker_cores', 'intra_op_threads', 'inter_op_threads'])
+
+
+def default_layouts(num_workers, num_cpus):
+    spare = max(1, (num_cpus - 1) // max(1, num_workers))
+    layouts = [
+        Layout('unpinned', False, 1, 1, 1, 2),
+        Layout('pinned-1', True, 1, 1, 1, 2),
+        Layout('pinned-1-inter1', True, 1, 1, 1, 1),
+    ]
+    if spare > 1:
+        layouts.append(Layout('pinned-%d' % spare, True, 1, spare, spare, 2))
+    return layouts
+
+
+def assign_cores(names, layout, nodes=None):
+    """
+Maps every process name to a list of cpus.  "ps" and "inf" get `ps_cores` dedicated cpus,
+every other process gets `worker_cores`.  Worker core sets are spread round-robin over the
+NUMA nodes, and only shared once every core is taken.
+"""
+    nodes = [list(n) for n in (nodes or numa_nodes())]
+    all_cpus = sorted(c for n in nodes for c in n)
+    assignment = {}
+
+    for name in names:
+        if name in ('ps', 'inf'):
+            node = max(nodes, key=len)
+            if len(node) <= 1:
+                # not enough cores to dedicate any, so share all of them
+                assignment[name] = all_cpus
+                continue
+            take = min(layout.ps_cores, len(node) - 1)
+            assignment[name] = node[:take]
+            del node[:take]
+
+    slots = []
+    per_node = [[n[i:i + layout.worker_cores] for i in range(0, len(n) - layout.worker_cores + 1, layout.worker_cores)]
+                for n in nodes]
+    while any(per_node):
+        for node_slots in per_node:
+            if node_slots:
+                slots.append(node_slots.pop(0))
+    if not slots:
+        slots = [sorted(c for n in nodes for c in n) or all_cpus]
+
+    workers = [name for name in names if name not in assignment]
+    for i, name in enumerate(workers):
+        assignment[name] = slots[i % len(slots)]
+    return assignment
+
+
+def pin_cmd(cmd, cpus):
+    # the first element of a worker command is the CUDA_VISIBLE_DEVICES= assignment,
+    # which has to stay in front of taskset
+    return cmd[:1] + ['taskset', '-c', format_cpulist(cpus)] + cmd[1:]
+
+
+def read_global_step(ps_address, timeout=1.0):
+    """Reads the global step straight off the parameter server."""
+    import tensorflow as tf
+    graph = tf.Graph()
+    with graph.as_default(), tf.device('/job:ps/task:0'):
+        with tf.variable_scope('global'):
+            global_step = tf.get_variable("global_step", [], tf.int32, trainable=False)
+    sess = tf.Session('grpc://' + ps_address, graph=graph)
+
+    def read():
+        try:
+            return sess.run(global_step, options=tf.RunOptions(timeout_in_ms=int(timeout * 1000)))
+        except tf.errors.OpError:
+            return 0
+    return read
+
+
+def measure_layout(cmds, ps_address, warmup=60.0, duration=60.0, logdir='/tmp'):
+    """
+Starts the given (name, argv) processes, waits for training to start, and returns the
+number of global steps per second over `duration` seconds.
+"""
+    procs = []
+    for name, cmd in cmds:
+        out = open(os.path.join(logdir, 'tune.{}.out'.format(name)), 'w')
+        # the commands start with an environment assignment, so they need a shell
+        procs.append(subprocess.Popen(' '.join(shlex_quote(str(v)) for v in cmd), shell=True, stdout=out, stderr=subprocess.STDOUT,
+                                      preexec_fn=os.setsid))
+    try:
+        read = read_global_step(ps_address)
+        deadline = time.time() + warmup
+        while read() == 0 and time.time() < deadline:
+            time.sleep(1.0)
+        time.sleep(min(10.0, warmup))
+        start_step, start = read(), time.time()
+        time.sleep(duration)
+        return (read() - start_step) / (time.time() - start)
+    finally:
+        for proc in procs:
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for proc in procs:
+            proc.wait()
+
+
+def auto_tune(layouts, make_cmds, ps_address, logdir, duration=60.0):
+    """
+Measures every layout with `make_cmds(layout)` (which should run on the synthetic env),
+writes the results to <logdir>/layout.json and returns the fastest layout.
+"""
+    results = []
+    for layout in layouts:
+        steps_per_sec = measure_layout(make_cmds(layout), ps_address, duration=duration, logdir=logdir)
+        print('Layout {}: {:.1f} steps/sec'.format(layout.name, steps_per_sec))
+        results.append((steps_per_sec, layout))
+
+    best = max(results, key=lambda r: r[0])[1]
+    with open(os.path.join(logdir, 'layout.json'), 'w') as f:
+        json.dump({'best': best._asdict(),
+                   'results': [dict(layout._asdict(), steps_per_sec=s) for s, layout in results]}, f, indent=2)
+    return best
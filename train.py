@@ -1,11 +1,16 @@
 import argparse
+import json
+import logging
 import os
 import sys
 from six.moves import shlex_quote
+import topology
+from supervisor import ProcessSupervisor, leave_path
+from launcher import SshLauncher, process_hosts, ssh_command, host_of
 
 parser = argparse.ArgumentParser(description="Run commands")
 worker_group = parser.add_mutually_exclusive_group(required=True)
-worker_group.add_argument('-w', '--num-workers', default=1, type=int,
+worker_group.add_argument('-w', '--num-workers', default=None, type=int,
                           help="Number of workers")
 worker_group.add_argument('--dist-workers',
                           help='Execute on distributed workers (e.g. --dist-workers someaddr:2222,someaddr2:2222).')
@@ -21,7 +26,102 @@ parser.add_argument('--log-universe', default=False, action="store_true",
 parser.add_argument('-n', '--dry-run', action='store_true',
                     help="Print out commands rather than executing them")
 parser.add_argument('-m', '--mode', type=str, default='tmux',
-                    help="tmux: run workers in a tmux session. nohup: run workers with nohup. child: run workers as child processes")
+                    help="tmux: run workers in a tmux session. nohup: run workers with nohup. child: run workers as child processes. "
+                         "supervise: run workers as child processes, restart them when they crash or hang, and "
+                         "report stragglers and throughput to <log-dir>/throughput.json. "
+                         "ssh: start the processes on the hosts of --dist-workers over ssh, collect their output in "
+                         "<log-dir> and wait until they are ready")
+parser.add_argument('--ssh', default='ssh -o BatchMode=yes',
+                    help="In ssh mode, the ssh command (with its options) used to reach the hosts")
+parser.add_argument('--remote-dir', default=None,
+                    help="In ssh mode, the directory of this repo on the hosts (default: the current directory)")
+parser.add_argument('--ready-timeout', default=900.0, type=float,
+                    help="In ssh mode, how long to wait for every process to be ready")
+parser.add_argument('--straggler-ratio', default=0.5, type=float,
+                    help="In supervise mode, flag workers running below this fraction of the median fps")
+parser.add_argument('--pin', default=False, action='store_true',
+                    help="Pin the ps and every worker to a disjoint set of cores (NUMA aware), "
+                         "and size their TF thread pools to match")
+parser.add_argument('--auto-tune', default=False, action='store_true',
+                    help="Try a few core layouts on the synthetic env first, and launch with the fastest "
+                         "(results go to <log-dir>/tune/layout.json). Only for sessions on this machine")
+parser.add_argument('--tune-seconds', default=60.0, type=float,
+                    help="How long each layout is measured for by --auto-tune")
+parser.add_argument('--inference-server', default=False, action='store_true',
+                    help="Run a shared inference server that the workers act through, instead of each "
+                         "worker running its own copy of the policy")
+parser.add_argument('--conv-filters', default=None,
+                    help="Number of filters of every 3x3 conv layer of the policy (e.g. 16,32,32)")
+parser.add_argument('--conv-strides', default=None,
+                    help="Stride of every conv layer of the policy (e.g. 2,2,2)")
+parser.add_argument('--downsample', default=None, type=int,
+                    help="Average-pool the observation by this factor before the first conv layer")
+parser.add_argument('--lstm-size', default=None, type=int,
+                    help="Number of units of the LSTM of the policy")
+parser.add_argument('--policy', default=None, choices=['lstm', 'ff'],
+                    help="lstm: a recurrent policy (the default). ff: a feed-forward policy without state, "
+                         "which sees the last --frame-stack frames")
+parser.add_argument('--frame-stack', default=None, type=int,
+                    help="Number of the latest frames stacked into every observation (e.g. 4 with --policy ff)")
+parser.add_argument('--profile-policy', default=False, action='store_true',
+                    help="Have worker 0 measure the FLOPs and the latency of every layer of the policy before "
+                         "training, and write them to <log-dir>/model_profile.json")
+parser.add_argument('--accumulate-rollouts', default=None, type=int,
+                    help="Have every worker sum the gradients of this many rollouts locally before applying "
+                         "them to the ps")
+parser.add_argument('--accumulate-steps', default=None, type=int,
+                    help="Have every worker sum the gradients of rollouts locally until they cover this many "
+                         "env steps, then apply them to the ps")
+parser.add_argument('--optimizer', default=None, choices=['adam', 'rmsprop'],
+                    help="Optimizer whose statistics all the workers share on the ps (default: adam). "
+                         "Checkpoints only restore with the optimizer they were written with.")
+parser.add_argument('--atari-backend', default=None, choices=['rgb', 'ale'],
+                    help="ale steps the emulator directly and reads its screen into a reused buffer, rather "
+                         "than through gym (gym atari envs only, same observations, default: rgb)")
+parser.add_argument('--adaptive-fps', default=None,
+                    help="MIN,MAX: have every worker adjust the fps of its VNC env within these bounds "
+                         "(e.g. --adaptive-fps 2,15)")
+parser.add_argument('--adaptive-encoding', default=False, action='store_true',
+                    help="Tune the VNC compression and quality of every remote from its observation lag and "
+                         "bandwidth (flash envs only)")
+parser.add_argument('--max-vnc-kbps', default=None, type=float,
+                    help="With --adaptive-encoding, also compress more when a remote sends more than this "
+                         "many KB/s")
+parser.add_argument('--memtrack-interval', default=None, type=float,
+                    help="Have every worker and the ps report their memory to TensorBoard every this many "
+                         "seconds, e.g. 120 (default: no reports)")
+parser.add_argument('--memtrack-threshold-mb', default=None, type=float,
+                    help="Write the allocations that grew the most to <log-dir>/memtrack whenever the RSS of a "
+                         "process grows by more than this (python 3 only, slows the processes down)")
+parser.add_argument('--spare-workers', default=0, type=int,
+                    help="Give every process N more worker slots than the workers started, which --join can "
+                         "start workers in later. With --dist-workers, the last N addresses are the spare slots")
+membership_group = parser.add_mutually_exclusive_group()
+membership_group.add_argument('--join', default=False, action='store_true',
+                              help="Start -w N workers in the spare worker slots of the running session in --log-dir")
+membership_group.add_argument('--leave', default=False, action='store_true',
+                              help="Ask the last -w N workers of the running session in --log-dir to stop")
+
+
+# the flags of train.py that every worker is given as they are (the defaults are those of worker.py)
+WORKER_FLAGS = ['conv_filters', 'conv_strides', 'downsample', 'lstm_size', 'policy', 'frame_stack', 'profile_policy',
+                'accumulate_rollouts', 'accumulate_steps', 'optimizer', 'atari_backend', 'adaptive_fps',
+                'adaptive_encoding', 'max_vnc_kbps']
+# the flags of train.py that the ps and the inference server are given too
+PROCESS_FLAGS = ['memtrack_interval', 'memtrack_threshold_mb']
+
+
+def forwarded_worker_args(args, flags=WORKER_FLAGS):
+    """The worker.py flags of the given flags (WORKER_FLAGS by default) given to train.py."""
+    cmd = []
+    for name in flags:
+        value = getattr(args, name)
+        flag = '--' + name.replace('_', '-')
+        if value is True:
+            cmd.append(flag)
+        elif value is not None and value is not False:
+            cmd += [flag, str(value)]
+    return cmd
 
 
 def new_cmd(session, name, cmd, mode, logdir, shell):
@@ -35,8 +135,42 @@ def new_cmd(session, name, cmd, mode, logdir, shell):
         return name, "nohup {} -c {} >{}/{}.{}.out 2>&1 & echo kill $! >>{}/kill.sh".format(shell, shlex_quote(cmd), logdir, session, name, logdir)
 
 
-def create_commands(session, num_workers, dist_workers, remotes, env_id, logdir,
-                    shell='bash', mode='tmux', log_universe=False):
+def cluster_addresses(num_workers, dist_workers, spare_workers=0):
+    """
+The address of the ps followed by those of the workers, and of the spare worker slots, which
+are the last spare_workers addresses of dist_workers.
+"""
+    if dist_workers is None:
+        port = 12222
+        return ['127.0.0.1:' + str(port + w) for w in range(num_workers + spare_workers)]
+    return dist_workers.split(',')
+
+
+def cluster_path(logdir):
+    return os.path.join(logdir, 'cluster.json')
+
+
+def write_cluster(logdir, cluster):
+    """Persists the membership of a session, for train.py --join and --leave."""
+    with open(cluster_path(logdir) + '.tmp', 'w') as f:
+        json.dump(cluster, f, indent=2)
+    os.rename(cluster_path(logdir) + '.tmp', cluster_path(logdir))
+
+
+def read_cluster(logdir):
+    with open(cluster_path(logdir)) as f:
+        return json.load(f)
+
+
+def create_process_cmds(num_workers, dist_workers, remotes, env_id, logdir, log_universe=False,
+                        inference_server=False, layout=None, worker_args=(), process_args=(), spare_workers=0):
+    """
+Returns the (name, argv) of the ps, the inference server and every worker.  If a layout is
+given, each process is pinned to its own set of cores and its TF thread pools sized to match.
+worker_args are added to the argv of every worker, and process_args to that of every process.
+Every process is given the addresses of the spare_workers spare slots too, but no worker is
+started in them.
+"""
     # for launching the TF workers and for launching tensorboard
     base_cmd = [
         'CUDA_VISIBLE_DEVICES=',
@@ -46,31 +180,53 @@ def create_commands(session, num_workers, dist_workers, remotes, env_id, logdir,
         base_cmd.append("--log-univer")
 
     num_ps = 1
-    if dist_workers is None:
-        port = 12222
-        workers = ['127.0.0.1:' + str(port + w) for w in range(num_workers)]
-    else:
-        workers = dist_workers.split(',')
-
-    base_cmd += ['--workers', ','.join(workers)]
+    workers = cluster_addresses(num_workers, dist_workers, spare_workers)
+    base_cmd += ['--workers', ','.join(workers)] + list(process_args)
+    num_started = len(workers) - num_ps - spare_workers
+    assert num_started > 0, 'no worker to start besides the {} spare slots'.format(spare_workers)
 
     if remotes is None:
-        remotes = ["1"] * len(workers)
+        remotes = ["1"] * num_started
     else:
         remotes = remotes.split(',')
-        assert len(remotes) == len(workers) - num_ps
-
-    cmds_map = [new_cmd(session, "ps",
-                        base_cmd + ["--job-name", "ps"],
-                        mode, logdir, shell)]
-    for i in range(len(workers) - num_ps):
-        cmds_map += [new_cmd(session, "w-%d" % i,
-                             base_cmd + ["--job-name", "worker",
-                                         "--task", str(i),
-                                         "--remotes", remotes[i]],
-                             mode, logdir, shell)]
-
-    cmds_map += [new_cmd(session, "tb", ["tensorboard", "--logdir", logdir, "--port", "12345"], mode, logdir, shell)]
+        assert len(remotes) == num_started
+
+    procs = [("ps", base_cmd + ["--job-name", "ps"])]
+    if inference_server:
+        base_cmd += ['--inference-address', os.path.join(logdir, 'inference.sock')]
+        procs += [("inf", base_cmd + ["--job-name", "inference"])]
+    for i in range(num_started):
+        procs += [("w-%d" % i, base_cmd + ["--job-name", "worker",
+                                           "--task", str(i),
+                                           "--remotes", remotes[i]] + list(worker_args))]
+
+    if layout is not None:
+        cores = topology.assign_cores([name for name, _ in procs], layout)
+        for i, (name, cmd) in enumerate(procs):
+            if layout.pin:
+                cmd = topology.pin_cmd(cmd, cores[name])
+            if name.startswith("w-"):
+                threads = [layout.intra_op_threads, layout.inter_op_threads]
+            else:
+                threads = [len(cores[name]), 2]
+            procs[i] = (name, cmd + ['--intra-op-threads', str(threads[0]), '--inter-op-threads', str(threads[1])])
+    return procs
+
+
+def create_commands(session, num_workers, dist_workers, remotes, env_id, logdir,
+                    shell='bash', mode='tmux', log_universe=False, inference_server=False, layout=None,
+                    worker_args=(), process_args=(), spare_workers=0):
+    procs = create_process_cmds(num_workers, dist_workers, remotes, env_id, logdir, log_universe=log_universe,
+                                inference_server=inference_server, layout=layout, worker_args=worker_args,
+                                process_args=process_args, spare_workers=spare_workers)
+    if mode != 'ssh':
+        # in ssh mode the events are written on the hosts of the workers
+        procs += [("tb", ["tensorboard", "--logdir", logdir, "--port", "12345"])]
+    if mode in ('supervise', 'ssh'):
+        # the processes are started by the supervisor (or the ssh launcher) rather than by shell commands
+        cmds_map = []
+    else:
+        cmds_map = [new_cmd(session, name, cmd, mode, logdir, shell) for name, cmd in procs]
     if mode == 'tmux':
         cmds_map += [new_cmd(session, "htop", ["htop"], mode, logdir, shell)]
 
@@ -81,15 +237,24 @@ def create_commands(session, num_workers, dist_workers, remotes, env_id, logdir,
         "mkdir -p {}".format(logdir),
         "echo {} {} > {}/cmd.sh".format(sys.executable, ' '.join([shlex_quote(arg) for arg in sys.argv if arg != '-n']), logdir),
     ]
-    if mode == 'nohup' or mode == 'child':
+    if mode in ('nohup', 'child', 'ssh'):
         cmds += ["echo '#!/bin/sh' >{}/kill.sh".format(logdir)]
         notes += ["Run `source {}/kill.sh` to kill the job".format(logdir)]
     if mode == 'tmux':
         notes += ["Use `tmux attach -t {}` to watch process output".format(session)]
         notes += ["Use `tmux kill-session -t {}` to kill the job".format(session)]
+    elif mode == 'supervise':
+        notes += ["Use `tail -f {}/*.out` to watch process output".format(logdir)]
+        notes += ["Per-worker throughput is written to {}/throughput.json".format(logdir)]
+        notes += ["Stop the supervisor (ctrl-c) to kill the job"]
+    elif mode == 'ssh':
+        notes += ["Use `tail -f {}/*.out` to watch process output, collected from all the hosts".format(logdir)]
+        notes += ["Run tensorboard on the host of each worker, where its events are written"]
     else:
         notes += ["Use `tail -f {}/*.out` to watch process output".format(logdir)]
-    notes += ["Point your browser to http://localhost:12345 to see Tensorboard"]
+    notes += ["Use `train.py --join -w N -l {0}` or `train.py --leave -w N -l {0}` to add or remove workers".format(logdir)]
+    if mode != 'ssh':
+        notes += ["Point your browser to http://localhost:12345 to see Tensorboard"]
 
     if mode == 'tmux':
         cmds += [
@@ -102,25 +267,184 @@ def create_commands(session, num_workers, dist_workers, remotes, env_id, logdir,
     for _, cmd in cmds_map:
         cmds += [cmd]
 
-    return cmds, notes
+    return cmds, notes, procs
+
+
+def join_commands(session, num_workers, remotes, logdir, shell='bash'):
+    """
+Returns the commands that start num_workers workers in the spare worker slots of the running
+session in logdir, their (name, argv), and the updated cluster.  The ps dials a worker back for
+every gradient the worker applies, through the cluster it was started with, so workers can only
+join in the slots that the session was launched with (--spare-workers).  The new workers take
+the first free slots, which are the task indices after the current workers.
+"""
+    cluster = read_cluster(logdir)
+    workers = list(cluster['workers'])
+    # sessions launched before the spare slots existed have none
+    slots = cluster.get('slots', workers)
+    num_free = len(slots) - len(workers)
+    assert 0 < num_workers <= num_free, \
+        'the session has {} free worker slots, launch it with --spare-workers for more'.format(num_free)
+    new_workers = slots[len(workers):len(workers) + num_workers]
+    new_remotes = remotes.split(',') if remotes is not None else ["1"] * len(new_workers)
+    assert len(new_remotes) == len(new_workers)
+
+    first_task = len(workers) - 1
+    cluster['workers'] = workers + new_workers
+    cluster['remotes'] = cluster['remotes'] + new_remotes
+    new_names = ["w-%d" % (first_task + i) for i in range(len(new_workers))]
+    procs = [(name, cmd) for name, cmd in create_process_cmds(
+                 None, ','.join(slots), ','.join(cluster['remotes']), cluster['env_id'], logdir,
+                 log_universe=cluster['log_universe'], inference_server=cluster['inference_server'],
+                 worker_args=cluster.get('worker_args', []), process_args=cluster.get('process_args', []),
+                 spare_workers=len(slots) - len(cluster['workers']))
+             if name in new_names]
+
+    mode = cluster['mode']
+    cmds = ["rm -f {}".format(' '.join(shlex_quote(leave_path(logdir, name)) for name in new_names))]
+    if mode == 'tmux':
+        cmds += ["tmux new-window -t {} -n {} {}".format(session, name, shell) for name in new_names]
+        cmds += ["sleep 1"]
+    if mode == 'ssh':
+        # the leave files are read on the hosts of the new workers, which the ssh launcher starts
+        hosts = process_hosts(procs, cluster['workers'])
+        cmds = [ssh_command(cluster['ssh'], hosts[name], "rm -f {}".format(shlex_quote(leave_path(logdir, name))))
+                for name, _ in procs]
+    elif mode != 'supervise':
+        cmds += [new_cmd(session, name, cmd, mode, logdir, shell)[1] for name, cmd in procs]
+    return cmds, procs, cluster
+
+
+def leave_commands(num_workers, logdir):
+    """Returns the commands that ask the last num_workers workers of the session to stop, and the updated cluster."""
+    cluster = read_cluster(logdir)
+    num_current = len(cluster['workers']) - 1
+    # worker 0 is the chief, which writes the checkpoints
+    assert 0 < num_workers < num_current, 'can only remove 1 to {} workers'.format(num_current - 1)
+    names = ["w-%d" % i for i in range(num_current - num_workers, num_current)]
+    hosts = [host_of(address) for address in cluster['workers'][-num_workers:]]
+    cluster['workers'] = cluster['workers'][:-num_workers]
+    cluster['remotes'] = cluster['remotes'][:-num_workers]
+    cmds = ["mkdir -p {}".format(shlex_quote(os.path.dirname(leave_path(logdir, names[0]))))]
+    cmds += ["touch {}".format(shlex_quote(leave_path(logdir, name))) for name in names]
+    if cluster['mode'] == 'ssh':
+        # the leave files are read on the hosts of the workers
+        cmds = [ssh_command(cluster['ssh'], host, "{} && {}".format(cmds[0], touch))
+                for host, touch in zip(hosts, cmds[1:])]
+    return cmds, cluster
+
+
+def change_membership(args):
+    if args.join:
+        cmds, procs, cluster = join_commands("a3c", args.num_workers, args.remotes, args.log_dir)
+    else:
+        cmds, cluster = leave_commands(args.num_workers, args.log_dir)
+    print("Dry-run mode due to -n flag, otherwise the following commands would be executed:" if args.dry_run
+          else "Executing the following commands:")
+    print("\n".join(cmds))
+    if args.dry_run:
+        return
+    if cluster['mode'] == "tmux":
+        os.environ["TMUX"] = ""
+    os.system("\n".join(cmds))
+    write_cluster(args.log_dir, cluster)
+    print("The session now has {} workers".format(len(cluster['workers']) - 1))
+    if args.join and cluster['mode'] == 'supervise':
+        logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+        ProcessSupervisor(procs, args.log_dir, straggler_ratio=args.straggler_ratio).run()
+    elif args.join and cluster['mode'] == 'ssh':
+        launch_ssh(procs, cluster, args)
+
+
+def launch_ssh(procs, cluster, args):
+    """Starts procs on the hosts of the cluster over ssh, and exits with an error unless they all become ready."""
+    logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+    launcher = SshLauncher(procs, process_hosts(procs, cluster['workers']), args.log_dir,
+                           ssh=cluster['ssh'], remote_dir=cluster['remote_dir'])
+    launcher.start()
+    failed = launcher.wait_ready(timeout=args.ready_timeout)
+    if failed:
+        sys.exit("Not ready: {} (see {}/a3c.<name>.out)".format(' '.join(failed), args.log_dir))
+    print("All {} processes are ready".format(len(procs)))
+
+
+def tune_layout(args):
+    """Measures the layouts on this machine, which is where the session runs (see run)."""
+    layouts = topology.default_layouts(args.num_workers, len(topology.available_cpus()))
+    tune_dir = os.path.join(args.log_dir, 'tune')
+    if not os.path.exists(tune_dir):
+        os.makedirs(tune_dir)
+
+    def make_cmds(layout):
+        # a fresh log dir per layout, so that no layout resumes from the checkpoint of another
+        logdir = os.path.join(tune_dir, layout.name)
+        env_id = 'synthetic.flash' if args.env_id.startswith('flashgames') else 'synthetic'
+        return create_process_cmds(args.num_workers, None, None, env_id, logdir,
+                                   inference_server=args.inference_server, layout=layout,
+                                   worker_args=[a for a in forwarded_worker_args(args) if a != '--profile-policy'])
+
+    return topology.auto_tune(layouts, make_cmds, cluster_addresses(args.num_workers, None)[0], tune_dir,
+                              duration=args.tune_seconds)
 
 
 def run():
     args = parser.parse_args()
-    cmds, notes = create_commands("a3c", args.num_workers, args.dist_workers, args.remotes,
-                                  args.env_id, args.log_dir, mode=args.mode,
-                                  log_universe=args.log_universe)
+    if args.mode == 'ssh' and args.inference_server:
+        # the workers reach the inference server over a unix socket of their own host
+        parser.error("--inference-server is not supported in ssh mode")
+    if args.auto_tune and (args.dist_workers is not None or args.mode == 'ssh'):
+        # the layouts would be measured on this machine, binding the addresses of the other hosts
+        parser.error("--auto-tune only measures this machine, it does not work with --dist-workers or ssh mode")
+
+    if args.join and args.dist_workers is not None:
+        # the addresses of the workers that can join are those of the spare slots
+        parser.error("--join takes -w N, the workers are started in the spare slots given by --spare-workers")
+    if args.join or args.leave:
+        change_membership(args)
+        return
+    layout = None
+    if args.auto_tune and not args.dry_run:
+        layout = tune_layout(args)
+        print("Using layout {}".format(layout))
+    elif args.pin or args.auto_tune:
+        num_workers = args.num_workers if args.dist_workers is None else \
+            len(args.dist_workers.split(',')) - 1 - args.spare_workers
+        layout = topology.default_layouts(num_workers, len(topology.available_cpus()))[1]
+    cmds, notes, procs = create_commands("a3c", args.num_workers, args.dist_workers, args.remotes,
+                                         args.env_id, args.log_dir, mode=args.mode,
+                                         log_universe=args.log_universe,
+                                         inference_server=args.inference_server,
+                                         layout=layout, worker_args=forwarded_worker_args(args),
+                                         process_args=forwarded_worker_args(args, PROCESS_FLAGS),
+                                         spare_workers=args.spare_workers)
     if args.dry_run:
         print("Dry-run mode due to -n flag, otherwise the following commands would be executed:")
     else:
         print("Executing the following commands:")
     print("\n".join(cmds))
+    if args.mode == 'ssh':
+        workers = cluster_addresses(args.num_workers, args.dist_workers, args.spare_workers)
+        print("\n".join(SshLauncher(procs, process_hosts(procs, workers), args.log_dir,
+                                    ssh=args.ssh, remote_dir=args.remote_dir).commands()))
     print("")
     if not args.dry_run:
         if args.mode == "tmux":
             os.environ["TMUX"] = ""
         os.system("\n".join(cmds))
+        slots = cluster_addresses(args.num_workers, args.dist_workers, args.spare_workers)
+        workers = slots[:len(slots) - args.spare_workers]
+        write_cluster(args.log_dir, {'workers': workers, 'slots': slots, 'mode': args.mode, 'env_id': args.env_id,
+                                     'remotes': args.remotes.split(',') if args.remotes else ["1"] * (len(workers) - 1),
+                                     'log_universe': args.log_universe, 'inference_server': args.inference_server,
+                                     'ssh': args.ssh, 'remote_dir': args.remote_dir or os.getcwd(),
+                                     'worker_args': forwarded_worker_args(args),
+                                     'process_args': forwarded_worker_args(args, PROCESS_FLAGS)})
     print('\n'.join(notes))
+    if args.mode == 'supervise' and not args.dry_run:
+        logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+        ProcessSupervisor(procs, args.log_dir, straggler_ratio=args.straggler_ratio).run()
+    elif args.mode == 'ssh' and not args.dry_run:
+        launch_ssh(procs, read_cluster(args.log_dir), args)
 
 
 if __name__ == "__main__":
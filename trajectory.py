@@ -0,0 +1,146 @@
+"""
+On-disk store for the experience collected by env_runner.  A recording is a directory with
+an index.json and fixed-size chunks, one .npy file per field per chunk, that are written
+and read through memory maps.  Observations are stored as uint8.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+from collections import namedtuple
+import gym
+import numpy as np
+from gym import spaces
+from gym.spaces.box import Box
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+FIELDS = ['obs', 'actions', 'rewards', 'values', 'dones']
+
+
+def _chunk_path(path, chunk, field):
+    return os.path.join(path, 'chunk-{:05d}.{}.npy'.format(chunk, field))
+
+
+class TrajectoryRecorder(object):
+    def __init__(self, path, ob_shape, num_actions, chunk_size=4096):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.ob_shape = list(ob_shape)
+        self.num_actions = num_actions
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.num_episodes = 0
+        self._arrays = None
+        self._length = 0
+        self._new_chunk()
+        atexit.register(self.close)
+
+    def _new_chunk(self):
+        chunk = len(self.chunks)
+        shapes = {'obs': ([self.chunk_size] + self.ob_shape, np.uint8),
+                  'actions': ([self.chunk_size], np.int32),
+                  'rewards': ([self.chunk_size], np.float32),
+                  'values': ([self.chunk_size], np.float32),
+                  'dones': ([self.chunk_size], np.bool_)}
+        self._arrays = dict((field, np.lib.format.open_memmap(_chunk_path(self.path, chunk, field), mode='w+',
+                                                              dtype=dtype, shape=tuple(shape)))
+                            for field, (shape, dtype) in shapes.items())
+        self.chunks.append(0)
+        self._length = 0
+
+    def add(self, ob, action, reward, value, done):
+        i = self._length
+        np.rint(np.asarray(ob) * 255.0, out=self._arrays['obs'][i], casting='unsafe')
+        self._arrays['actions'][i] = action
+        self._arrays['rewards'][i] = reward
+        self._arrays['values'][i] = value
+        self._arrays['dones'][i] = done
+        self._length += 1
+        self.chunks[-1] = self._length
+
+        if done:
+            self.num_episodes += 1
+            self._write_index()
+        if self._length == self.chunk_size:
+            self._flush()
+            self._write_index()
+            self._new_chunk()
+
+    def _flush(self):
+        for array in self._arrays.values():
+            array.flush()
+
+    def _write_index(self):
+        index = {'ob_shape': self.ob_shape, 'num_actions': self.num_actions, 'chunk_size': self.chunk_size,
+                 'chunks': self.chunks, 'num_episodes': self.num_episodes}
+        tmp = os.path.join(self.path, 'index.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp, os.path.join(self.path, 'index.json'))
+
+    def close(self):
+        if self._arrays is not None:
+            self._flush()
+            self._write_index()
+
+
+class TrajectoryReader(object):
+    def __init__(self, path):
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.ob_shape = index['ob_shape']
+        self.num_actions = index['num_actions']
+        self.num_episodes = index['num_episodes']
+        self.chunks = [dict((field, np.load(_chunk_path(path, chunk, field), mmap_mode='r')[:length])
+                            for field in FIELDS)
+                       for chunk, length in enumerate(index['chunks']) if length > 0]
+        self.offsets = np.cumsum([0] + [len(chunk['dones']) for chunk in self.chunks])
+        self.length = int(self.offsets[-1])
+
+    def __len__(self):
+        return self.length
+
+    def get(self, i):
+        """Returns observation, action, reward, value and done of step i."""
+        chunk = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        arrays = self.chunks[chunk]
+        j = i - self.offsets[chunk]
+        return (arrays['obs'][j] * np.float32(1.0 / 255.0), arrays['actions'][j], arrays['rewards'][j],
+                arrays['values'][j], arrays['dones'][j])
+
+
+ReplaySpec = namedtuple('ReplaySpec', ['id', 'tags'])
+
+
+class ReplayEnv(gym.Env):
+    """
+Plays back a recording as fast as it is stepped, looping at the end, and ignores the actions
+it is given.  Good for measuring the learner without live environments.
+"""
+    metadata = {'semantics.autoreset': True}
+
+    def __init__(self, path, client_id='0'):
+        if not os.path.exists(os.path.join(path, 'index.json')):
+            # a directory of per-worker recordings
+            recordings = sorted(os.path.dirname(p) for p in glob.glob(os.path.join(path, '*', 'index.json')))
+            assert recordings, 'No recordings found in {}'.format(path)
+            path = recordings[int(client_id) % len(recordings)]
+        logger.info('Replaying %s', path)
+        self.reader = TrajectoryReader(path)
+        assert len(self.reader) > 1, 'Recording {} is empty'.format(path)
+        self.observation_space = Box(0.0, 1.0, self.reader.ob_shape)
+        self.action_space = spaces.Discrete(self.reader.num_actions)
+        self.spec = ReplaySpec('replay:' + path, {'wrapper_config.TimeLimit.max_episode_steps': len(self.reader)})
+        self._t = 0
+
+    def _reset(self):
+        return self.reader.get(self._t)[0]
+
+    def _step(self, action):
+        _, _, reward, _, done = self.reader.get(self._t)
+        self._t = (self._t + 1) % len(self.reader)
+        return self.reader.get(self._t)[0], float(reward), bool(done), {}
@@ -7,7 +7,12 @@ import logging
 import sys, signal
 import time
 import os
-from a3c import A3C
+import json
+from a3c import A3C, FastSaver
+import inference
+from model import PolicyConfig, profile_policy, format_profile
+from supervisor import status_path, write_status, leave_path
+from memtrack import MemoryTracker
 from envs import create_env
 from envs import config_universe_logging
 import distutils.version
@@ -16,16 +21,32 @@ use_tf12_api = distutils.version.LooseVersion(tf.VERSION) >= distutils.version.L
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Disables write_meta_graph argument, which freezes entire process and is mostly useless.
-class FastSaver(tf.train.Saver):
-    def save(self, sess, save_path, global_step=None, latest_filename=None,
-             meta_graph_suffix="meta", write_meta_graph=True):
-        super(FastSaver, self).save(sess, save_path, global_step, latest_filename,
-                                    meta_graph_suffix, False)
-
 def run(args, server):
-    env = create_env(args.env_id, client_id=str(args.task), remotes=args.remotes)
-    trainer = A3C(env, args.task)
+    adaptive_fps = [float(fps) for fps in args.adaptive_fps.split(',')] if args.adaptive_fps else None
+    env = create_env(args.env_id, client_id=str(args.task), remotes=args.remotes, frame_stack=args.frame_stack,
+                     atari_backend=args.atari_backend, adaptive_fps=adaptive_fps, adaptive_encoding=args.adaptive_encoding,
+                     max_vnc_bytes_per_sec=args.max_vnc_kbps * 1024 if args.max_vnc_kbps else None)
+    record_dir = os.path.join(args.record_dir, 'w-%d' % args.task) if args.record_dir else None
+    policy_config = PolicyConfig(filters=[int(f) for f in args.conv_filters.split(',')],
+                                 strides=[int(s) for s in args.conv_strides.split(',')],
+                                 downsample=args.downsample, lstm_size=args.lstm_size,
+                                 policy=args.policy, frames=args.frame_stack)
+    if args.task == 0:
+        if args.profile_policy:
+            profile = profile_policy(env.observation_space.shape, env.action_space.n, policy_config)
+            logger.info('Policy profile (single act step, one thread):\n%s', format_profile(profile))
+        else:
+            # the config alone, which evaluate.py reads
+            profile = {'config': policy_config._asdict(), 'ob_space': list(env.observation_space.shape),
+                       'ac_space': env.action_space.n}
+        if not os.path.exists(args.log_dir):
+            os.makedirs(args.log_dir)
+        with open(os.path.join(args.log_dir, 'model_profile.json'), 'w') as f:
+            json.dump(profile, f, indent=2)
+    trainer = A3C(env, args.task, inference_address=args.inference_address,
+                  frozen_policy=args.frozen_policy, record_dir=record_dir, policy_config=policy_config,
+                  accumulate_rollouts=args.accumulate_rollouts, accumulate_steps=args.accumulate_steps,
+                  optimizer=args.optimizer)
 
     # Variable names that start with "local" are not saved in checkpoints.
     if use_tf12_api:
@@ -56,6 +77,11 @@ def run(args, server):
         summary_writer = tf.train.SummaryWriter(logdir + "_%d" % args.task)
 
     logger.info("Events directory: %s_%s", logdir, args.task)
+    memory_tracker = None
+    if args.memtrack_interval:
+        memory_tracker = MemoryTracker('w-%d' % args.task, summary_writer, interval=args.memtrack_interval,
+                                       queues={'rollouts': trainer.runner.queue}, devices=["/job:worker/task:{}/cpu:0".format(args.task)],
+                                       threshold_mb=args.memtrack_threshold_mb, logdir=args.log_dir)
     sv = tf.train.Supervisor(is_chief=(args.task == 0),
                              logdir=logdir,
                              saver=saver,
@@ -75,17 +101,45 @@ def run(args, server):
         "One common cause is that the parameter server DNS name isn't resolving yet, or is misspecified.")
     with sv.managed_session(server.target, config=config) as sess, sess.as_default():
         trainer.start(sess, summary_writer)
+        if memory_tracker is not None:
+            memory_tracker.start_tracking(sess, trainer.global_step)
         global_step = sess.run(trainer.global_step)
         logger.info("Starting training at step=%d", global_step)
+        status = status_path(args.log_dir, 'w-%d' % args.task)
+        leave = leave_path(args.log_dir, 'w-%d' % args.task)
+        last_report, last_env_steps = time.time(), 0
         while not sv.should_stop() and (not num_global_steps or global_step < num_global_steps):
+            if os.path.exists(leave):
+                logger.info('Asked to leave the session (%s)', leave)
+                break
             trainer.process(sess)
             global_step = sess.run(trainer.global_step)
 
+            elapsed = time.time() - last_report
+            if elapsed > args.status_interval:
+                write_status(status, task=args.task, global_step=int(global_step),
+                             env_steps=trainer.env_steps, fps=(trainer.env_steps - last_env_steps) / elapsed)
+                last_report, last_env_steps = time.time(), trainer.env_steps
+
     # Ask for all the services to stop.
     sv.stop()
     logger.info('reached %s steps. worker stopped.', global_step)
 
 
+def track_ps_memory(args, server):
+    """
+The ps runs no training loop of its own, so it gets a session and an events directory
+(<log-dir>/ps_<task>) just for reporting its memory.
+"""
+    logdir = os.path.join(args.log_dir, 'ps_%d' % args.task)
+    summary_writer = tf.summary.FileWriter(logdir) if use_tf12_api else tf.train.SummaryWriter(logdir)
+    memory_tracker = MemoryTracker('ps-%d' % args.task, summary_writer, interval=args.memtrack_interval,
+                                   devices=["/job:ps/task:{}/cpu:0".format(args.task)],
+                                   threshold_mb=args.memtrack_threshold_mb, logdir=args.log_dir)
+    sess = tf.Session(server.target, config=tf.ConfigProto(device_filters=["/job:ps"]))
+    memory_tracker.start_tracking(sess)
+
+
 def main(_):
     """
 Setting up Tensorflow for data parallel work
@@ -94,7 +148,7 @@ Setting up Tensorflow for data parallel work
     parser = argparse.ArgumentParser(description=None)
     parser.add_argument('-v', '--verbose', action='count', dest='verbosity', default=0, help='Set verbosity.')
     parser.add_argument('--task', default=0, type=int, help='Task index')
-    parser.add_argument('--job-name', default="worker", help='worker or ps')
+    parser.add_argument('--job-name', default="worker", help='worker, ps or inference')
 
     parser.add_argument('--workers',
                         help='Execute on distributed tf (ps + worker) (e.g. --workers someaddr:2222,someaddr2:2222).')
@@ -102,18 +156,88 @@ Setting up Tensorflow for data parallel work
     parser.add_argument('--log-dir', default="/tmp/pong", help='Log directory path')
     parser.add_argument('--log-universe', default=False, action="store_true",
                         help='Save universe log to /tmp/univese-<pid>')
-    parser.add_argument('--env-id', default="PongDeterministic-v3", help='Environment id')
+    parser.add_argument('--env-id', default="PongDeterministic-v3",
+                        help='Environment id, or replay:<dir> to play back recordings made with --record-dir')
+    parser.add_argument('--record-dir', default=None,
+                        help='Record the experience of every worker to <record-dir>/w-<task>')
     parser.add_argument('-r', '--remotes', default=None,
                         help='References to environments to create (e.g. -r 20), '
                              'or the address of pre-existing VNC servers and '
                              'rewarders to use (e.g. -r vnc://localhost:5900+15900,vnc://localhost:5901+15901)')
+    parser.add_argument('--inference-address', default=None,
+                        help='Unix socket path (or host:port) of the inference server of this host. '
+                             'Workers act through it, the inference job listens on it.')
+    parser.add_argument('--status-interval', default=30.0, type=float,
+                        help='Seconds between updates of <log-dir>/status/w-<task>.json, read by train.py --mode supervise')
+    parser.add_argument('--intra-op-threads', default=None, type=int,
+                        help='Size of the TF intra-op thread pool (default: 1 for workers, all cores for the ps)')
+    parser.add_argument('--inter-op-threads', default=None, type=int,
+                        help='Size of the TF inter-op thread pool (default: 2 for workers, all cores for the ps)')
+    parser.add_argument('--frozen-policy', default=False, action="store_true",
+                        help='Act through a pruned copy of the local policy in a session of its own, whose weights are '
+                             'refreshed on every sync')
+    parser.add_argument('--inference-port', default=12221, type=int,
+                        help='Port of the inference job in the tf cluster')
+    parser.add_argument('--inference-batch-size', default=32, type=int,
+                        help='Maximum number of actors evaluated in one batch by the inference job')
+    parser.add_argument('--inference-max-wait', default=0.002, type=float,
+                        help='Seconds the inference job waits for a batch to fill up')
+    parser.add_argument('--conv-filters', default='32,32,32,32',
+                        help='Number of filters of every 3x3 conv layer of the policy')
+    parser.add_argument('--conv-strides', default='2,2,2,2',
+                        help='Stride of every conv layer of the policy')
+    parser.add_argument('--downsample', default=1, type=int,
+                        help='Average-pool the observation by this factor before the first conv layer')
+    parser.add_argument('--lstm-size', default=256, type=int,
+                        help='Number of units of the LSTM of the policy (or of the hidden layer of --policy ff)')
+    parser.add_argument('--profile-policy', default=False, action="store_true",
+                        help='Measure the FLOPs and the latency of every layer of the policy before training '
+                             '(worker 0 only), and write them to <log-dir>/model_profile.json')
+    parser.add_argument('--policy', default='lstm', choices=['lstm', 'ff'],
+                        help='lstm: a recurrent policy. ff: a feed-forward policy without state, which sees '
+                             'the last --frame-stack frames')
+    parser.add_argument('--frame-stack', default=1, type=int,
+                        help='Number of the latest frames stacked into every observation (e.g. 4 with --policy ff)')
+    parser.add_argument('--accumulate-rollouts', default=None, type=int,
+                        help='Sum the gradients of this many rollouts locally before applying them to the ps')
+    parser.add_argument('--accumulate-steps', default=None, type=int,
+                        help='Sum the gradients of rollouts locally until they cover this many env steps, '
+                             'then apply them to the ps (whichever comes first with --accumulate-rollouts)')
+    parser.add_argument('--optimizer', default='adam', choices=['adam', 'rmsprop'],
+                        help='Optimizer whose statistics all the workers share on the ps. '
+                             'Checkpoints only restore with the optimizer they were written with.')
+    parser.add_argument('--atari-backend', default='rgb', choices=['rgb', 'ale'],
+                        help='ale steps the emulator directly and reads its screen into a reused buffer, '
+                             'rather than through gym (gym atari envs only, same observations)')
+    parser.add_argument('--adaptive-fps', default=None,
+                        help='MIN,MAX: adjust the fps of VNC envs within these bounds, from the action and '
+                             'observation lags and the time the actor has to spare (e.g. --adaptive-fps 2,15)')
+    parser.add_argument('--memtrack-interval', default=0.0, type=float,
+                        help='Seconds between reports of the memory of the process to TensorBoard, e.g. 120 '
+                             '(default: no reports)')
+    parser.add_argument('--memtrack-threshold-mb', default=None, type=float,
+                        help='Write the allocations that grew the most to <log-dir>/memtrack whenever the RSS '
+                             'grows by more than this (python 3 only, slows the process down)')
+    parser.add_argument('--adaptive-encoding', default=False, action="store_true",
+                        help='Tune the VNC compression and quality of every remote from its observation lag '
+                             'and bandwidth (flash envs only)')
+    parser.add_argument('--max-vnc-kbps', default=None, type=float,
+                        help='With --adaptive-encoding, also compress more when a remote sends more than '
+                             'this many KB/s')
 
     args = parser.parse_args()
 
     config_universe_logging(enable_logfile=args.log_universe)
     workers = args.workers.split(',')
     num_ps = 1
-    cluster = tf.train.ClusterSpec({'ps': workers[0:num_ps], 'worker': workers[num_ps:]}).as_cluster_def()
+    # the ps dials a worker back for every gradient the worker applies (the RecvTensor RPC of the gradient),
+    # and finds it in this list, so the ps must be started with every worker that will ever train with it
+    # (train.py --spare-workers adds slots to the list for workers that join later)
+    cluster_spec = {'ps': workers[0:num_ps], 'worker': workers[num_ps:]}
+    if args.job_name == "inference":
+        # the inference job of each host is its own single-task job, nobody else ever dials it
+        cluster_spec['inference'] = ['localhost:{}'.format(args.inference_port)]
+    cluster = tf.train.ClusterSpec(cluster_spec).as_cluster_def()
 
     def shutdown(signal, _):
         logger.warn('Received signal %s: exiting', signal)
@@ -124,11 +248,22 @@ Setting up Tensorflow for data parallel work
 
     if args.job_name == "worker":
         server = tf.train.Server(cluster, job_name="worker", task_index=args.task,
-                                 config=tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=2))
+                                 config=tf.ConfigProto(intra_op_parallelism_threads=args.intra_op_threads or 1,
+                                                       inter_op_parallelism_threads=args.inter_op_threads or 2))
         run(args, server)
+    elif args.job_name == "inference":
+        server = tf.train.Server(cluster, job_name="inference", task_index=0,
+                                 config=tf.ConfigProto(intra_op_parallelism_threads=args.intra_op_threads or 0,
+                                                       inter_op_parallelism_threads=args.inter_op_threads or 0))
+        inference.run(args, server)
     else:
         server = tf.train.Server(cluster, job_name="ps", task_index=args.task,
-                                 config=tf.ConfigProto(device_filters=["/job:ps"]))
+                                 config=tf.ConfigProto(device_filters=["/job:ps"],
+                                                       intra_op_parallelism_threads=args.intra_op_threads or 0,
+                                                       inter_op_parallelism_threads=args.inter_op_threads or 0))
+        if args.memtrack_interval:
+            track_ps_memory(args, server)
+        logger.info('Parameter server ready on %s', workers[args.task])
         while True:
             time.sleep(1000)
 